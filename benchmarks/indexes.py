@@ -0,0 +1,90 @@
+"""Benchmarks the common queries of sets whose set objects are mostly
+removed, before and after creating the indexes of `objectset.indexes`.
+
+    python benchmarks/indexes.py [sets] [objects per set]
+
+The tests app models are used with a temporary SQLite database.
+"""
+import os
+import sys
+import random
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings  # noqa
+
+path = tempfile.mktemp(suffix='.db')
+
+settings.configure(
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': path,
+        },
+    },
+    INSTALLED_APPS=(
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'objectset',
+        'tests',
+    ),
+)
+
+from django.core.management import call_command  # noqa
+from django.db import transaction  # noqa
+from objectset.indexes import create_missing_indexes  # noqa
+from tests.models import Record, RecordSet  # noqa
+
+
+def populate(sets, size):
+    "Creates sets with 90% of their set objects removed."
+    # The initial data of the tests app may contain records
+    Record.objects.all().delete()
+    Record.objects.bulk_create([Record(pk=i) for i in xrange(1, size + 1)])
+
+    for i in xrange(sets):
+        s = RecordSet(save=True)
+        s.bulk(xrange(1, size + 1))
+        s.remove_many(random.sample(xrange(1, size + 1), size * 9 // 10))
+
+    transaction.commit_unless_managed()
+
+
+def run(label, instance, size):
+    pks = [random.randint(1, size) for _ in xrange(100)]
+
+    queries = [
+        ('iterate', lambda: list(instance.pks())),
+        ('contains x100', lambda: [Record(pk=pk) in instance for pk in pks]),
+        ('contains_many', lambda: instance.contains_many(pks)),
+        ('recount', lambda: instance.recount(dry_run=True)),
+    ]
+
+    print label
+
+    for name, func in queries:
+        seconds = min(timeit.repeat(func, number=5, repeat=3)) / 5
+        print '    {0:<15} {1:8.2f} ms'.format(name, seconds * 1000)
+
+
+def main(sets=20, size=20000):
+    call_command('syncdb', interactive=False, verbosity=0)
+    populate(sets, size)
+
+    instance = RecordSet.objects.all()[sets // 2]
+
+    run('Without indexes', instance, size)
+
+    for index in create_missing_indexes(RecordSet):
+        print 'Created {0}'.format(index.name)
+
+    run('With indexes', instance, size)
+
+
+if __name__ == '__main__':
+    try:
+        main(*[int(x) for x in sys.argv[1:]])
+    finally:
+        os.remove(path)
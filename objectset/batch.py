@@ -0,0 +1,98 @@
+from django.db import transaction
+
+
+class SetBatch(object):
+    """Buffers additions and removals of objects to a set and applies them
+    when the batch is flushed, which is done on exit when used as a context
+    manager. Use `ObjectSet.batch()` to create one:
+
+        with bookset.batch() as batch:
+            for book in books:
+                batch.add(book)
+            batch.remove(other_book)
+
+        batch.added     # primary keys of the books actually added
+        batch.removed   # primary keys of the books actually removed
+
+    Only the last change of an object is kept, so adding and then removing
+    an object is the same as only removing it. On flush, the membership of
+    the changed objects is looked up in batches, the set objects are
+    inserted, restored and removed in bulk and the count of the set is
+    updated once. If an exception is raised within the block, the buffered
+    changes are discarded.
+    """
+    def __init__(self, instance, added=False, delete=False):
+        self.instance = instance
+        self._added = added
+        self.delete = delete
+
+        # Primary key to true for additions and false for removals
+        self._changes = {}
+
+        self.added = set()
+        self.removed = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._changes = {}
+
+    def __len__(self):
+        "Returns the number of buffered changes."
+        return len(self._changes)
+
+    def add(self, obj):
+        "Buffers the addition of `obj`."
+        self._changes[self._pk(obj)] = True
+
+    def remove(self, obj):
+        "Buffers the removal of `obj`."
+        self._changes[self._pk(obj)] = False
+
+    def update(self, objs):
+        "Buffers the addition of multiple objects."
+        for obj in objs:
+            self.add(obj)
+
+    def remove_many(self, objs):
+        "Buffers the removal of multiple objects."
+        for obj in objs:
+            self.remove(obj)
+
+    def _pk(self, obj):
+        return list(self.instance._iter_pks([obj], allow_pks=True))[0]
+
+    @transaction.commit_on_success
+    def flush(self):
+        """Applies the buffered changes to the set. Returns the number of
+        objects actually added and removed as a tuple. The primary keys of
+        the objects are accumulated in `added` and `removed`.
+        """
+        instance = self.instance
+        instance._check_pk()
+
+        changes, self._changes = self._changes, {}
+
+        if not changes:
+            return 0, 0
+
+        contained = instance.contains_many(changes.keys())
+
+        adds = [pk for pk, add in changes.items() if add and not contained[pk]]
+        removes = [pk for pk, add in changes.items()
+                   if not add and contained[pk]]
+
+        removed = instance._remove_many(removes, delete=self.delete)
+        added = instance._add_many(adds, self._added)
+
+        if added or removed:
+            instance._update_count(added - removed)
+
+        self.added.update(adds)
+        self.removed.update(removes)
+
+        return added, removed
@@ -0,0 +1,337 @@
+"""Lazy set expressions compiled into flat SQL.
+
+Set operators build a tree of expressions rather than nesting querysets.
+The tree is simplified as it is built, e.g. `a & a` is `a` and a union with
+an empty set is the other operand, and compiled into a single statement
+selecting the primary keys of the objects. Backends supporting compound
+queries use `UNION`, `INTERSECT` and `EXCEPT` while the others use a
+predicate of correlated `EXISTS` and `IN` clauses on the objects table.
+"""
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+
+UNION = 'union'
+INTERSECTION = 'intersection'
+DIFFERENCE = 'difference'
+SYMMETRIC_DIFFERENCE = 'symmetric_difference'
+
+# Backends which support compound queries with `INTERSECT` and `EXCEPT`
+COMPOUND_VENDORS = ('sqlite', 'postgresql', 'oracle')
+
+COMPOUND_KEYWORDS = {
+    UNION: 'UNION',
+    INTERSECTION: 'INTERSECT',
+    DIFFERENCE: 'EXCEPT',
+}
+
+
+class SetExpression(object):
+    "Base class for set expressions."
+    def __and__(self, other):
+        return combine(INTERSECTION, self, other)
+
+    def __or__(self, other):
+        return combine(UNION, self, other)
+
+    def __xor__(self, other):
+        return combine(SYMMETRIC_DIFFERENCE, self, other)
+
+    def __sub__(self, other):
+        return combine(DIFFERENCE, self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class Empty(SetExpression):
+    "The empty set."
+    def __eq__(self, other):
+        return isinstance(other, Empty)
+
+    def __repr__(self):
+        return 'Empty()'
+
+
+EMPTY = Empty()
+
+
+class SetLeaf(SetExpression):
+    "The objects contained in a saved set."
+    def __init__(self, instance):
+        self.instance = instance
+
+    def __eq__(self, other):
+        return isinstance(other, SetLeaf) \
+            and other.instance.__class__ is self.instance.__class__ \
+            and other.instance.pk == self.instance.pk
+
+    def __repr__(self):
+        return 'SetLeaf({0}, {1})'.format(self.instance.__class__.__name__,
+                                          self.instance.pk)
+
+    def _sql(self, connection):
+        "Returns the set object columns and filters of this set."
+        table, set_column, object_column, where, params = \
+            self.instance._set_object_sql(connection)
+
+        where.insert(0, '{0} = %s'.format(set_column))
+        params.insert(0, self.instance.pk)
+
+        return table, object_column, where, params
+
+    def select_sql(self, connection):
+        table, object_column, where, params = self._sql(connection)
+
+        sql = 'SELECT {0} FROM {1} WHERE {2}'.format(
+            object_column, table, ' AND '.join(where))
+
+        return sql, params
+
+    def predicate_sql(self, column, connection):
+        table, object_column, where, params = self._sql(connection)
+        where.insert(0, '{0} = {1}'.format(object_column, column))
+
+        sql = 'EXISTS (SELECT 1 FROM {0} WHERE {1})'.format(
+            table, ' AND '.join(where))
+
+        return sql, params
+
+
+class CountLeaf(SetExpression):
+    """The objects contained in at least `minimum` of the saved sets of
+    `model` with the primary keys `pks`, answered with a single scan of the
+    set objects.
+    """
+    def __init__(self, model, pks, minimum):
+        self.model = model
+        self.pks = tuple(sorted(set(pks)))
+        self.minimum = minimum
+
+    def __eq__(self, other):
+        return isinstance(other, CountLeaf) and other.model is self.model \
+            and other.pks == self.pks and other.minimum == self.minimum
+
+    def __repr__(self):
+        return 'CountLeaf({0}, {1}, {2})'.format(self.model.__name__,
+                                                 list(self.pks), self.minimum)
+
+    def select_sql(self, connection):
+        table, set_column, object_column, where, params = \
+            self.model._set_object_sql(connection)
+
+        where.insert(0, '{0} IN ({1})'.format(
+            set_column, ', '.join(['%s'] * len(self.pks))))
+        params[:0] = self.pks
+
+        if self.minimum <= 1:
+            return 'SELECT DISTINCT {0} FROM {1} WHERE {2}'.format(
+                object_column, table, ' AND '.join(where)), params
+
+        sql = 'SELECT {0} FROM {1} WHERE {2} GROUP BY {0} ' \
+            'HAVING COUNT(DISTINCT {3}) >= %s'.format(
+                object_column, table, ' AND '.join(where), set_column)
+
+        return sql, params + [self.minimum]
+
+    def predicate_sql(self, column, connection):
+        sql, params = self.select_sql(connection)
+        return '{0} IN ({1})'.format(column, sql), params
+
+
+class QuerySetLeaf(SetExpression):
+    """The objects in a queryset, e.g. the pending objects of a set.
+
+    The ordering of sliced querysets is kept since it determines the objects
+    selected, the query is wrapped in a subquery instead.
+    """
+    def __init__(self, queryset):
+        self.source = queryset
+        if queryset.query.can_filter():
+            queryset = queryset.order_by()
+        self.queryset = queryset.values_list('pk', flat=True)
+
+    @classmethod
+    def for_queryset(cls, queryset):
+        "Returns a leaf for `queryset` or `EMPTY` if it is known to be empty."
+        if queryset is None or isinstance(queryset, EmptyQuerySet):
+            return EMPTY
+
+        leaf = cls(queryset)
+
+        try:
+            leaf.queryset.query.get_compiler(leaf.queryset.db).as_sql()
+        except EmptyResultSet:
+            return EMPTY
+
+        return leaf
+
+    def __eq__(self, other):
+        return isinstance(other, QuerySetLeaf) and other.source is self.source
+
+    def __repr__(self):
+        return 'QuerySetLeaf({0})'.format(self.queryset.model.__name__)
+
+    def select_sql(self, connection):
+        query = self.queryset.query
+        sql, params = query.get_compiler(connection=connection).as_sql()
+
+        # SQLite does not allow limits and orderings within compound
+        # queries and MySQL does not allow limits in `IN` subqueries
+        if not query.can_filter():
+            sql = 'SELECT * FROM ({0}) U'.format(sql)
+
+        return sql, list(params)
+
+    def predicate_sql(self, column, connection):
+        sql, params = self.select_sql(connection)
+        return '{0} IN ({1})'.format(column, sql), params
+
+
+class Operation(SetExpression):
+    "A set operation on two expressions."
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def __eq__(self, other):
+        return isinstance(other, Operation) \
+            and other.operator == self.operator \
+            and other.left == self.left and other.right == self.right
+
+    def __repr__(self):
+        return 'Operation({0}, {1!r}, {2!r})'.format(
+            self.operator, self.left, self.right)
+
+    def expand(self):
+        """Returns an equivalent operation only using unions, intersections
+        and differences.
+        """
+        if self.operator == SYMMETRIC_DIFFERENCE:
+            return Operation(DIFFERENCE,
+                             Operation(UNION, self.left, self.right),
+                             Operation(INTERSECTION, self.left, self.right))
+        return self
+
+    def select_sql(self, connection):
+        operation = self.expand()
+
+        if operation is not self:
+            return operation.select_sql(connection)
+
+        left_sql, left_params = self.left.select_sql(connection)
+        right_sql, right_params = self.right.select_sql(connection)
+
+        keyword = COMPOUND_KEYWORDS[self.operator]
+
+        if connection.vendor == 'oracle' and self.operator == DIFFERENCE:
+            keyword = 'MINUS'
+
+        if connection.vendor == 'sqlite':
+            # SQLite evaluates compound operators from left to right with
+            # equal precedence and does not support parenthesized operands.
+            # The left operand can be inlined, while a compound right
+            # operand must be wrapped in a subquery.
+            if isinstance(self.right, Operation):
+                right_sql = 'SELECT * FROM ({0})'.format(right_sql)
+            sql = '{0} {1} {2}'.format(left_sql, keyword, right_sql)
+        else:
+            sql = '({0}) {1} ({2})'.format(left_sql, keyword, right_sql)
+
+        return sql, left_params + right_params
+
+    def predicate_sql(self, column, connection):
+        operation = self.expand()
+
+        if operation is not self:
+            return operation.predicate_sql(column, connection)
+
+        left_sql, left_params = self.left.predicate_sql(column, connection)
+        right_sql, right_params = self.right.predicate_sql(column,
+                                                           connection)
+
+        if self.operator == UNION:
+            template = '({0} OR {1})'
+        elif self.operator == INTERSECTION:
+            template = '({0} AND {1})'
+        else:
+            template = '({0} AND NOT {1})'
+
+        return template.format(left_sql, right_sql), \
+            left_params + right_params
+
+
+def combine(operator, left, right):
+    "Returns an expression of `operator` applied to `left` and `right`."
+    if operator == UNION:
+        if left == EMPTY or left == right:
+            return right
+        if right == EMPTY:
+            return left
+
+    elif operator == INTERSECTION:
+        if left == EMPTY or left == right:
+            return left
+        if right == EMPTY:
+            return right
+
+    elif operator == DIFFERENCE:
+        if left == EMPTY or right == EMPTY:
+            return left
+        if left == right:
+            return EMPTY
+
+    elif operator == SYMMETRIC_DIFFERENCE:
+        if left == right:
+            return EMPTY
+        if left == EMPTY:
+            return right
+        if right == EMPTY:
+            return left
+
+    else:
+        raise ValueError('Unknown set operator {0}'.format(operator))
+
+    return Operation(operator, left, right)
+
+
+class ExpressionSubquery(object):
+    """Wraps an expression so it can be used as the value of an `in` lookup.
+    The SQL is self-contained and compiled for the connection the outer
+    query is executed against.
+    """
+    def __init__(self, expression, model):
+        self.expression = expression
+        self.model = model
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        if connection.vendor in COMPOUND_VENDORS:
+            return self.expression.select_sql(connection)
+
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        column = '{0}.{1}'.format(qn(opts.db_table), qn(opts.pk.column))
+        where, params = self.expression.predicate_sql(column, connection)
+
+        sql = 'SELECT {0} FROM {1} WHERE {2}'.format(
+            column, qn(opts.db_table), where)
+
+        return sql, params
+
+
+def compile_queryset(expression, model):
+    """Returns a queryset of `model` containing the objects of `expression`.
+    The objects are selected with a single subquery suited for the database
+    backend.
+    """
+    if expression == EMPTY:
+        return model._default_manager.none()
+
+    return model._default_manager\
+        .filter(pk__in=ExpressionSubquery(expression, model))
@@ -15,16 +15,14 @@ def objectset_form_factory(Model, queryset=None):
     if not issubclass(Model, ObjectSet):
         raise TypeError('{0} must subclass ObjectSet'.format(Model.__name__))
 
-    instance = Model()
-
     if queryset is None:
-        queryset = instance._object_class._default_manager.all()
-    elif queryset.model is not instance._object_class:
+        queryset = Model._object_class._default_manager.all()
+    elif queryset.model is not Model._object_class:
         raise TypeError('ObjectSet of type {0}, not {1}'
-                        .format(instance._object_class.__name__,
+                        .format(Model._object_class.__name__,
                                 queryset.model.__name__))
 
-    label = getattr(Model, instance._set_object_rel).field.verbose_name
+    label = getattr(Model, Model._set_object_rel).field.verbose_name
 
     class form_class(forms.ModelForm):
         objects = forms.ModelMultipleChoiceField(queryset, label=label,
@@ -55,7 +53,7 @@ def objectset_form_factory(Model, queryset=None):
 
         class Meta(object):
             model = Model
-            exclude = (instance._set_object_rel,)
+            exclude = (Model._set_object_rel,)
 
     form_class.__name__ = '{0}Form'.format(Model.__name__)
 
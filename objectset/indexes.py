@@ -0,0 +1,202 @@
+"""Indexes of the set object tables of sets.
+
+Most queries of a set filter its set objects by the set and `removed` flag
+and read the object column, e.g. iterating, membership tests, `clear()` and
+`purge()`. For set object classes subclassing `SetObject`, a composite index
+of the set, `removed` and object columns covers these queries. On backends
+supporting partial indexes, an index of the set and object columns limited
+to the objects not removed is added so tombstones are not scanned.
+
+The abstract `SetObject` does not know the names of the foreign keys of its
+subclasses, so it cannot declare these indexes with `index_together`, and
+Django 1.4 to 1.6 cannot declare partial indexes at all. They are created by
+`create_missing_indexes`, the `objectset_indexes` command or on `syncdb` if
+the `OBJECTSET_CREATE_INDEXES` setting is true. Existing indexes can only be
+listed on the backends in `LISTED_VENDORS`.
+"""
+from django.db import connections, router, transaction
+from django.db.backends.util import truncate_name
+
+# Backends whose existing indexes can be listed, see `get_existing_indexes`
+LISTED_VENDORS = ('sqlite', 'postgresql', 'mysql')
+
+
+class SetObjectIndex(object):
+    "Definition of an index on a set object table."
+    def __init__(self, name, table, columns, where=None):
+        self.name = name
+        self.table = table
+        self.columns = tuple(columns)
+        self.where = where
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self.name)
+
+    @property
+    def partial(self):
+        return self.where is not None
+
+    def sql(self, connection):
+        "Returns the statement creating the index."
+        qn = connection.ops.quote_name
+
+        sql = 'CREATE INDEX {0} ON {1} ({2})'.format(
+            qn(self.name), qn(self.table),
+            ', '.join([qn(c) for c in self.columns]))
+
+        if self.where:
+            sql += ' WHERE {0}'.format(self.where)
+
+        return sql
+
+
+def supports_partial_indexes(connection):
+    "Returns true if the backend supports partial indexes."
+    if connection.vendor == 'postgresql':
+        return True
+
+    if connection.vendor == 'sqlite':
+        cursor = connection.cursor()
+        cursor.execute('SELECT sqlite_version()')
+        version = tuple([int(x) for x in cursor.fetchone()[0].split('.')])
+        return version >= (3, 8, 0)
+
+    return False
+
+
+def _false_literal(connection):
+    if connection.vendor == 'postgresql':
+        return 'false'
+    return '0'
+
+
+def get_set_object_indexes(model, connection):
+    "Returns the indexes of the set object table of the set class `model`."
+    opts = model._set_object_class._meta
+    max_length = connection.ops.max_name_length()
+
+    table = opts.db_table
+    set_column = opts.get_field(model._through_set_rel).column
+    object_column = opts.get_field(model._through_object_rel).column
+
+    if not model._set_object_class_supported:
+        # Auto-created through models are unique on these already
+        if opts.auto_created:
+            return []
+
+        return [SetObjectIndex(
+            truncate_name('{0}_objset_members'.format(table), max_length),
+            table, [set_column, object_column])]
+
+    removed_column = opts.get_field('removed').column
+
+    indexes = [SetObjectIndex(
+        truncate_name('{0}_objset_members'.format(table), max_length),
+        table, [set_column, removed_column, object_column])]
+
+    if supports_partial_indexes(connection):
+        where = '{0} = {1}'.format(connection.ops.quote_name(removed_column),
+                                   _false_literal(connection))
+
+        indexes.append(SetObjectIndex(
+            truncate_name('{0}_objset_live'.format(table), max_length),
+            table, [set_column, object_column], where=where))
+
+    return indexes
+
+
+def get_existing_indexes(connection, table):
+    """Returns a dict of the names of the indexes on `table` to their
+    columns in order. This is supported for SQLite, PostgreSQL and MySQL.
+    """
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    indexes = {}
+
+    if connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list({0})'.format(qn(table)))
+
+        for row in cursor.fetchall():
+            name = row[1]
+            cursor.execute('PRAGMA index_info({0})'.format(qn(name)))
+            indexes[name] = [r[2] for r in sorted(cursor.fetchall())]
+
+    elif connection.vendor == 'postgresql':
+        # Columns of each index in order, up to the default maximum of 32
+        cursor.execute('''
+            SELECT i.relname, pg_get_indexdef(x.indexrelid, k, true)
+            FROM pg_index x
+                INNER JOIN pg_class t ON t.oid = x.indrelid
+                INNER JOIN pg_class i ON i.oid = x.indexrelid
+                CROSS JOIN generate_series(1, 32) k
+            WHERE t.relname = %s AND k <= x.indnatts
+            ORDER BY i.relname, k
+        ''', [table])
+
+        for name, column in cursor.fetchall():
+            indexes.setdefault(name, []).append(column)
+
+    elif connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM {0}'.format(qn(table)))
+        rows = sorted(cursor.fetchall(), key=lambda r: (r[2], r[3]))
+
+        for row in rows:
+            indexes.setdefault(row[2], []).append(row[4])
+
+    else:
+        raise NotImplementedError('Listing indexes is not supported for '
+                                  '{0}'.format(connection.vendor))
+
+    return indexes
+
+
+def get_missing_indexes(model, using=None):
+    """Returns the indexes of the set object table of the set class `model`
+    which do not exist. A full index exists if an index with the same
+    leading columns does, a partial index must exist with the same name.
+    """
+    if using is None:
+        using = router.db_for_write(model._set_object_class)
+
+    connection = connections[using]
+    indexes = get_set_object_indexes(model, connection)
+
+    if not indexes:
+        return []
+
+    existing = get_existing_indexes(connection, indexes[0].table)
+    missing = []
+
+    for index in indexes:
+        if index.name in existing:
+            continue
+
+        if not index.partial:
+            size = len(index.columns)
+            if [c for c in existing.values()
+                    if tuple(c[:size]) == index.columns]:
+                continue
+
+        missing.append(index)
+
+    return missing
+
+
+def create_missing_indexes(model, using=None):
+    """Creates the missing indexes of the set object table of the set class
+    `model` and returns them.
+    """
+    if using is None:
+        using = router.db_for_write(model._set_object_class)
+
+    connection = connections[using]
+    missing = get_missing_indexes(model, using=using)
+
+    cursor = connection.cursor()
+
+    for index in missing:
+        cursor.execute(index.sql(connection))
+
+    transaction.commit_unless_managed(using=using)
+
+    return missing
@@ -0,0 +1,33 @@
+from django.db.models import get_model, get_models
+from django.core.management.base import CommandError
+from objectset.models import ObjectSet
+
+
+def get_objectset_models(labels=None):
+    """Returns the ObjectSet subclasses for the `app_label.ModelName` labels
+    or all installed ones if no labels are given.
+    """
+    if not labels:
+        return [m for m in get_models() if issubclass(m, ObjectSet)]
+
+    models = []
+
+    for label in labels:
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError('Models must be specified as '
+                               '`app_label.ModelName`, got {0}'.format(label))
+
+        model = get_model(app_label, model_name)
+
+        if model is None:
+            raise CommandError('Unknown model {0}'.format(label))
+
+        if not issubclass(model, ObjectSet):
+            raise CommandError('{0} is not an ObjectSet subclass'
+                               .format(label))
+
+        models.append(model)
+
+    return models
@@ -0,0 +1,58 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from objectset.models import BATCH_SIZE
+from objectset.management import get_objectset_models
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+
+    help = 'Deletes the removed set objects of sets due for compaction'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--time-limit', action='store', dest='time_limit',
+                    type='float', default=None,
+                    help='Stop after this many seconds'),
+        make_option('--batch-size', action='store', dest='batch_size',
+                    type='int', default=BATCH_SIZE,
+                    help='Number of set objects deleted per query'),
+        make_option('--after', action='store', dest='after', default=None,
+                    help='Resume after the set with this primary key, '
+                         'requires a single model'),
+    )
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        time_limit = options.get('time_limit')
+        batch_size = options.get('batch_size') or BATCH_SIZE
+        after = options.get('after')
+
+        models = get_objectset_models(labels)
+
+        if after is not None and len(models) != 1:
+            raise CommandError('--after requires a single model')
+
+        deadline = None
+
+        if time_limit is not None:
+            deadline = time.time() + time_limit
+
+        for model in models:
+            remaining = None
+
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+
+            deleted, last = model.compact(batch_size=batch_size,
+                                          time_limit=remaining, after=after)
+
+            if verbosity > 0:
+                self.stdout.write('Deleted {0} removed objects of {1} sets\n'
+                                  .format(deleted, model.__name__))
+
+            if last is not None:
+                self.stdout.write('Stopped after {0} {1}, resume with '
+                                  '--after={1}\n'
+                                  .format(model.__name__, last))
+                break
@@ -0,0 +1,44 @@
+from optparse import make_option
+from django.db import connections, router, DEFAULT_DB_ALIAS
+from django.core.management.base import BaseCommand
+from objectset.indexes import get_missing_indexes, create_missing_indexes
+from objectset.management import get_objectset_models
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+
+    help = 'Prints or creates the missing indexes of set object tables'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--create', action='store_true', dest='create',
+                    default=False,
+                    help='Create the missing indexes rather than printing '
+                         'their SQL'),
+        make_option('--database', action='store', dest='database',
+                    default=None,
+                    help='Database to check, defaults to the one the set '
+                         'objects are written to'),
+    )
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        create = options.get('create', False)
+        database = options.get('database')
+
+        for model in get_objectset_models(labels):
+            using = database or \
+                router.db_for_write(model._set_object_class) or \
+                DEFAULT_DB_ALIAS
+
+            if create:
+                indexes = create_missing_indexes(model, using=using)
+
+                if verbosity > 0:
+                    self.stdout.write('Created {0} indexes for {1}\n'
+                                      .format(len(indexes), model.__name__))
+            else:
+                connection = connections[using]
+
+                for index in get_missing_indexes(model, using=using):
+                    self.stdout.write('{0};\n'.format(index.sql(connection)))
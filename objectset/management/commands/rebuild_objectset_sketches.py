@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from objectset.management import get_objectset_models
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+
+    help = 'Rebuilds the sketches of object sets from the objects they contain'
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        for model in get_objectset_models(labels):
+            if not model.hll_field and not model.minhash_field:
+                continue
+
+            rebuilt = 0
+
+            for instance in model._default_manager.iterator():
+                instance.rebuild_sketches()
+                rebuilt += 1
+
+            if verbosity > 0:
+                self.stdout.write('Rebuilt sketches of {0} {1} sets\n'
+                                  .format(rebuilt, model.__name__))
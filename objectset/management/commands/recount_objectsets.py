@@ -0,0 +1,34 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from objectset.management import get_objectset_models
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+
+    help = 'Recomputes the stored counts of object sets'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Report the sets whose count drifted without '
+                         'correcting them'),
+    )
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options.get('dry_run', False)
+
+        for model in get_objectset_models(labels):
+            drift = model.recount_all(dry_run=dry_run)
+
+            if verbosity > 1:
+                for pk, (stored, actual) in sorted(drift.items()):
+                    self.stdout.write('{0} {1}: {2} -> {3}\n'
+                                      .format(model.__name__, pk, stored,
+                                              actual))
+
+            if verbosity > 0:
+                self.stdout.write('{0} {1} sets with drifted counts{2}\n'
+                                  .format(len(drift), model.__name__,
+                                          '' if dry_run else ', corrected'))
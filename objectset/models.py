@@ -1,13 +1,270 @@
+import time
 import django
+import warnings
 from datetime import datetime
-from django.db import models, transaction
+from django.db import models, transaction, connections, router
+from django.db.models import Count, F
 from django.db.models.query import QuerySet, EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.db.models.manager import ManagerDescriptor
+from django.conf import settings
+from django.core.cache import get_cache
 from django.core.exceptions import ImproperlyConfigured
 from .exceptions import ObjectSetError
-from .decorators import cached_property
+from .pkset import PKSet
+from .batch import SetBatch
+from .indexes import create_missing_indexes, LISTED_VENDORS
+from .sketches import HyperLogLog, MinHash, band_hashes
+from .expressions import SetLeaf, QuerySetLeaf, CountLeaf, EMPTY, \
+    ExpressionSubquery, compile_queryset
 
 BULK_SUPPORTED = django.VERSION >= (1, 4)
+UPDATE_FIELDS_SUPPORTED = django.VERSION >= (1, 5)
+
+# Number of objects handled per query when adding or removing objects in
+# bulk. This keeps the number of query parameters below SQLite's default
+# limit of 999 variables.
+BATCH_SIZE = 200
+
+# Number of set objects read per query when exporting sets to arrays.
+ARRAY_CHUNK_SIZE = 10000
+
+
+def _chunked(iterable, size):
+    "Yields lists of at most `size` items from `iterable`."
+    chunk = []
+
+    for item in iterable:
+        chunk.append(item)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _set_pk(s, cls):
+    """Returns the primary key of the set `s` given as an instance or primary
+    key of the set class `cls`.
+    """
+    if isinstance(s, ObjectSet):
+        if not isinstance(s, cls):
+            raise TypeError("Only sets of type '{0}' are supported"
+                            .format(cls.__name__))
+        return s.pk
+    return s
+
+
+def _set_pks(sets, cls):
+    """Returns the distinct primary keys of `sets` given as instances or
+    primary keys of the set class `cls`.
+    """
+    return set([_set_pk(s, cls) for s in sets])
+
+
+class _PKSubquery(object):
+    """Wraps a queryset of primary keys so it can be used as the value of an
+    `in` lookup of an update or delete. MySQL does not allow a subquery on
+    the table being changed, e.g. the set objects of the set itself, so it
+    is selected from a derived table which is materialized first.
+    """
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        sql, params = self.queryset.query\
+            .get_compiler(connection=connection).as_sql()
+
+        if connection.vendor == 'mysql':
+            sql = 'SELECT * FROM ({0}) U'.format(sql)
+
+        return sql, params
+
+
+def _import_numpy():
+    "Imports NumPy which is only required by the array methods."
+    try:
+        import numpy
+    except ImportError:
+        raise ImproperlyConfigured('numpy must be installed to use the '
+                                   'array methods')
+    return numpy
+
+
+class SetRelation(object):
+    """Metadata of the relation between an `ObjectSet` subclass, the
+    through model and the object model, e.g. Team <- TeamPlayer -> Player.
+    It is resolved once per class when the class and the models it refers
+    to have been prepared, and cannot be changed.
+
+    - `set_object_rel` is the name of the many-to-many field on the set
+      class. It can be specified explicitly via the `set_object_rel`
+      attribute of the class or is detected if there is only one
+      many-to-many field, e.g. `Team.team_players`
+    - `through_set_rel` and `through_object_rel` are the names of the
+      foreign keys on the through model to the set and to the object, e.g.
+      `TeamPlayer.team` and `TeamPlayer.player`. They can be specified via
+      the `object_set_rel` and `set_object_rel` attributes of the through
+      model or are detected if there is only one foreign key to each.
+    - `set_object_class` is the through model, e.g. `TeamPlayer`
+    - `object_class` is the object model, e.g. `Player`
+    - `set_object_class_supported` is true if the through model subclasses
+      `SetObject` for extended features.
+    """
+    __slots__ = ('set_object_rel', 'through_set_rel', 'through_object_rel',
+                 'set_object_class', 'object_class',
+                 'set_object_class_supported')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Set relations cannot be changed')
+
+    def __delattr__(self, name):
+        raise AttributeError('Set relations cannot be changed')
+
+    def __repr__(self):
+        return '{0}({1} <- {2} -> {3})'.format(
+            self.__class__.__name__, self.set_object_rel,
+            self.set_object_class.__name__, self.object_class.__name__)
+
+    @classmethod
+    def resolve(cls, model):
+        """Returns the relation of the set class `model` or None if the
+        through or object model has not been prepared yet.
+        """
+        set_object_rel = _get_set_object_rel(model)
+        field = model._meta.get_field(set_object_rel)
+
+        through = field.rel.through
+        object_class = field.rel.to
+
+        # Lazy references to models which are not defined yet
+        if isinstance(through, basestring) or \
+                isinstance(object_class, basestring):
+            return None
+
+        return cls(set_object_rel=set_object_rel,
+                   through_set_rel=_get_through_rel(
+                       through, model, 'object_set_rel', 'set'),
+                   through_object_rel=_get_through_rel(
+                       through, object_class, 'set_object_rel', 'object'),
+                   set_object_class=through,
+                   object_class=object_class,
+                   set_object_class_supported=issubclass(through, SetObject))
+
+
+def _get_set_object_rel(model):
+    "Returns the name of the many-to-many field of the set class `model`."
+    if hasattr(model, 'set_object_rel'):
+        return model.set_object_rel
+
+    # Not defined, so it is assumed to only have one M2M field
+    m2m_fields = model._meta.many_to_many
+
+    if not m2m_fields:
+        raise ImproperlyConfigured('At least one many-to-many '
+                                   'relationship must exist on object '
+                                   'sets.')
+
+    if len(m2m_fields) != 1:
+        raise ImproperlyConfigured('No explicit set object relation '
+                                   'has been defined, but more than '
+                                   'one many-to-many relationship '
+                                   'exists on this object set. Define '
+                                   '`set_object_rel` name on the '
+                                   'class.')
+
+    return m2m_fields[0].name
+
+
+def _get_through_rel(through, to, attr, label):
+    """Returns the name of the foreign key on the through model to the model
+    `to`. It can be defined explicitly by the `attr` attribute of the through
+    model. A foreign key to a parent of `to` is used if there is none to `to`
+    itself, e.g. for proxies and multi-table children of set classes.
+    """
+    if hasattr(through, attr):
+        return getattr(through, attr)
+
+    fields = [f for f in through._meta.fields
+              if isinstance(f, models.ForeignKey) and
+              not isinstance(f.rel.to, basestring)]
+
+    matches = [f for f in fields if f.rel.to is to]
+
+    if not matches:
+        matches = [f for f in fields if issubclass(to, f.rel.to)]
+
+    if len(matches) > 1:
+        raise ImproperlyConfigured('No explicit through model {0} '
+                                   'field relation has been defined, '
+                                   'but more than one exists.'
+                                   .format(label))
+
+    if not matches:
+        raise ImproperlyConfigured('No through model {0} field relation '
+                                   'was found.'.format(label))
+
+    return matches[0].name
+
+
+# Resolved relations by set class and the set classes which refer to models
+# that have not been prepared yet
+_relations = {}
+_pending_relations = []
+
+
+def get_set_relation(model):
+    "Returns the `SetRelation` of the set class `model`."
+    try:
+        return _relations[model]
+    except KeyError:
+        pass
+
+    relation = SetRelation.resolve(model)
+
+    if relation is None:
+        raise ImproperlyConfigured('The through or object model of {0} has '
+                                   'not been defined'.format(model.__name__))
+
+    _relations[model] = relation
+    return relation
+
+
+def _prepare_relations(sender, **kwargs):
+    """Resolves the relations of set classes when they are prepared, or once
+    the models they refer to lazily are. Invalid relations are reported when
+    the models are loaded rather than when first used.
+    """
+    if issubclass(sender, ObjectSet) and not sender._meta.abstract:
+        _pending_relations.append(sender)
+
+    for model in _pending_relations[:]:
+        relation = SetRelation.resolve(model)
+
+        if relation is not None:
+            _relations[model] = relation
+            _pending_relations.remove(model)
+
+
+class _relation_property(object):
+    "Returns an attribute of the `SetRelation` of the set class."
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, type=None):
+        return getattr(get_set_relation(type), self.name)
 
 
 class ObjectSetManagerDescriptor(ManagerDescriptor):
@@ -31,6 +288,21 @@ class ObjectSetManager(models.Manager):
         super(ObjectSetManager, self).contribute_to_class(model, name)
         setattr(model, name, ObjectSetManagerDescriptor(self))
 
+    def containing(self, obj):
+        """Returns the sets containing `obj`, an object or its primary key,
+        e.g. `Team.objects.containing(player)`.
+        """
+        model = self.model
+        pk = list(model._iter_pks([obj], allow_pks=True))[0]
+
+        lookups = model._member_kwargs()
+        lookups[model._through_object_rel] = pk
+
+        pks = model._set_object_class.objects.filter(**lookups)\
+            .values(model._through_set_rel)
+
+        return self.filter(pk__in=pks)
+
 
 class ObjectSet(models.Model):
     """Encapsulates a set of objects of a particular type and provides
@@ -57,14 +329,81 @@ class ObjectSet(models.Model):
     # the objects this set contains. This proxies to `_objects()`
     objects = ObjectSetManager()
 
+    # If true, the results of membership tests are cached on the instance
+    # until the set is saved, which all methods changing the set do.
+    cache_membership = False
+
+    _membership = None
+
+    # Name of a text field defined on the subclass for storing a HyperLogLog
+    # sketch of the set to estimate sizes of sets, unions and intersections
+    # without querying the set objects. The sketch is updated as objects are
+    # added, but objects cannot be removed from it. It is rebuilt when the
+    # set is cleared, saved with pending objects or by calling
+    # `rebuild_sketches` (see the `rebuild_objectset_sketches` command).
+    hll_field = None
+
+    # Precision of the HyperLogLog sketch, see `objectset.sketches`
+    hll_precision = 12
+
+    # Name of a text field defined on the subclass for storing a MinHash
+    # signature of the set used by `similar_to` to find similar sets. It is
+    # maintained like the HyperLogLog sketch.
+    minhash_field = None
+
+    # Number of hash functions of the MinHash signature and the number of
+    # bands of the locality-sensitive hashing index, which must divide it
+    minhash_permutations = 128
+    minhash_bands = 32
+
+    # Whether the sketches of this instance had primary keys added or were
+    # reset since they were last written
+    _sketches_changed = False
+    _sketches_reset = False
+
+    # Compaction policy of the sets of this class, see `compact`. The set
+    # objects marked as `removed` of a set are deleted once they make up at
+    # least `compaction_ratio` of its set objects and, if `compaction_age` is
+    # a timedelta, the set has not been modified for that long.
+    compaction_ratio = 0.5
+    compaction_age = None
+
+    # If true, the primary keys of the objects in saved sets are stored
+    # compressed in the Django cache `members_cache` under a key including
+    # a version of the set kept in the cache, which every change increments
+    # so all instances of the set stop using the previous key. Membership
+    # tests, `pks()`, iteration and operators between cached sets are then
+    # answered without reading the set objects. Sets larger than
+    # `members_cache_max_size` objects or `members_cache_max_bytes`
+    # compressed are not cached.
+    cache_members = False
+    members_cache = 'default'
+    members_cache_timeout = None
+    members_cache_max_size = 100000
+    members_cache_max_bytes = 1024 * 1024
+
+    # The cache key and primary keys of the cached members
+    _members = None
+
+    # If true, the objects of saved sets without pending objects are ordered
+    # by when they were added, i.e. by the primary key of the set objects
+    insertion_order = False
+
+    # The expression the pending queryset was compiled from
+    _compiled = None
+
+    # The pending queryset and its count, see `__len__`
+    _pending_count = None
+
     class Meta(object):
         abstract = True
 
-    @transaction.commit_on_success
-    def __init__(self, *args, **kwargs):
-        # Set to an empty queryset
-        self._pending = self._object_class.objects.none()
+    # The queryset of pending objects or None if there are none. This is
+    # only set by the constructor and operators so instances loaded from the
+    # database do not create a queryset, see `_pending`
+    _pending_objects = None
 
+    def __init__(self, *args, **kwargs):
         queryset = None
         save = kwargs.pop('save', False)
 
@@ -77,16 +416,19 @@ class ObjectSet(models.Model):
 
         if queryset is not None:
             # Create a queryset if this is a list of tuple of instances
-            if not isinstance(queryset, QuerySet) and len(queryset):
+            if not isinstance(queryset, QuerySet):
+                if not len(queryset):
+                    queryset = None
                 # If these are list of models, extra their primary keys
                 # otherwise a assume a list of pks
-                if isinstance(queryset[0], models.Model):
-                    pks = [x.pk for x in queryset]
                 else:
-                    pks = queryset
-                queryset = self._object_class.objects.filter(pk__in=pks)
+                    if isinstance(queryset[0], models.Model):
+                        pks = [x.pk for x in queryset]
+                    else:
+                        pks = queryset
+                    queryset = self._object_class.objects.filter(pk__in=pks)
 
-            self._pending = queryset
+            self._pending_objects = queryset
 
         super(ObjectSet, self).__init__(*args, **kwargs)
 
@@ -94,8 +436,38 @@ class ObjectSet(models.Model):
             self.save()
 
     def __len__(self):
-        "Returns the length (size) of this set."
-        return self.count
+        """Returns the length (size) of this set.
+
+        Saved sets use the stored count. For unsaved sets, such as the result
+        of an operator, the pending objects are counted with one query. The
+        count is cached until the pending objects change.
+        """
+        if self.pk or not self._has_pending():
+            return self.count
+
+        pending = self._pending_objects
+
+        if self._pending_count is None \
+                or self._pending_count[0] is not pending:
+            self._pending_count = (pending, pending.count())
+
+        return self._pending_count[1]
+
+    def _get_pending(self):
+        "Returns the queryset of pending objects, which may be empty."
+        if self._pending_objects is None:
+            self._pending_objects = self._object_class.objects.none()
+        return self._pending_objects
+
+    def _set_pending(self, queryset):
+        self._pending_objects = queryset
+
+    _pending = property(_get_pending, _set_pending)
+
+    def _has_pending(self):
+        "Returns true if there are pending objects."
+        return self._pending_objects is not None \
+            and not isinstance(self._pending_objects, EmptyQuerySet)
 
     def __nonzero__(self):
         "Prevents the set from being falsy."
@@ -106,171 +478,548 @@ class ObjectSet(models.Model):
 
     def __iter__(self):
         "Iterates over the objects in the set."
+        if not self.insertion_order:
+            pks = self._cached_pks(load=False)
+
+            if pks is not None:
+                return self._iter_cached(pks)
+
         return iter(self.objects)
 
+    def _iter_cached(self, pks):
+        "Yields the objects for the cached `pks` in batches."
+        manager = self._object_class._default_manager
+
+        for chunk in _chunked(pks, BATCH_SIZE):
+            objects = manager.in_bulk(chunk)
+
+            for pk in chunk:
+                if pk in objects:
+                    yield objects[pk]
+
     def __contains__(self, obj):
-        "Returns True if `obj` is in this set."
-        return self._set_object_exists(obj)
+        "Returns True if `obj`, an object or primary key, is in this set."
+        pk = list(self._iter_pks([obj], allow_pks=True))[0]
+        pks = self._cached_pks()
+
+        if pks is not None:
+            return pk in pks
+
+        if not self.cache_membership:
+            return self._set_object_exists(pk, **self._member_kwargs())
+
+        if self._membership is None:
+            self._membership = {}
+
+        if pk not in self._membership:
+            self._membership[pk] = \
+                self._set_object_exists(pk, **self._member_kwargs())
+
+        return self._membership[pk]
 
     def __and__(self, other):
         "Performs an intersection of this set and `other`."
-        return self.__class__(other.objects & self.objects)
+        cached = self._from_cached(other, PKSet.intersection)
+        if cached is not None:
+            return cached
+        return self._from_expression(self._expression() &
+                                     self._operand(other))
 
     def __or__(self, other):
         "Performs an union of this set and `other`."
-        return self.__class__(other.objects | self.objects)
+        cached = self._from_cached(other, PKSet.union)
+        if cached is not None:
+            return cached
+        return self._from_expression(self._expression() |
+                                     self._operand(other))
 
     def __xor__(self, other):
         "Performs an exclusive union of this set and `other`."
-        excluded = models.Q(pk__in=(other.objects & self.objects))
-        return self.__class__((other.objects | self.objects)
-                              .exclude(excluded))
+        cached = self._from_cached(other, PKSet.symmetric_difference)
+        if cached is not None:
+            return cached
+        return self._from_expression(self._expression() ^
+                                     self._operand(other))
 
     def __sub__(self, other):
         "Removes objects from this set that are in `other`."
-        excluded = models.Q(pk__in=other.objects)
-        return self.__class__(self.objects.exclude(excluded))
+        cached = self._from_cached(other, PKSet.difference)
+        if cached is not None:
+            return cached
+        return self._from_expression(self._expression() -
+                                     self._operand(other))
 
     def __iand__(self, other):
         "Performs an inplace intersection of this set and `other`."
-        self._pending = other.objects & self.objects
+        self._set_pending_expression(self._expression() &
+                                     self._operand(other))
         return self
 
     def __ior__(self, other):
         "Performs and inplace union of this set and `other`."
-        self._pending = other.objects | self.objects
+        self._set_pending_expression(self._expression() |
+                                     self._operand(other))
         return self
 
     def __ixor__(self, other):
         "Performs an inplace exclusive union of this set and `other`."
-        excluded = models.Q(pk__in=(other.objects & self.objects))
-        self._pending = (other.objects | self.objects).exclude(excluded)
+        self._set_pending_expression(self._expression() ^
+                                     self._operand(other))
         return self
 
     def __isub__(self, other):
         "Inplace removal of objects from this set that are in `other`."
-        excluded = models.Q(pk__in=other.objects)
-        self._pending = self.objects.exclude(excluded)
+        self._set_pending_expression(self._expression() -
+                                     self._operand(other))
         return self
 
-    @cached_property
-    def _set_object_rel(self):
-        """Return the relation name of the many-to-many model between this
-        set class and the object model. This can be specified explicitly via
-        the `set_object_rel` property or it will be detected if there is only
-        one many-to-many on this class, e.g. `Team.team_players`
+    # Metadata of the relation between the set class, the through model and
+    # the object model resolved once per class, see `SetRelation`
+    _set_object_rel = _relation_property('set_object_rel')
+    _through_set_rel = _relation_property('through_set_rel')
+    _through_object_rel = _relation_property('through_object_rel')
+    _set_object_class = _relation_property('set_object_class')
+    _object_class = _relation_property('object_class')
+    _set_object_class_supported = \
+        _relation_property('set_object_class_supported')
+
+    def _operand(self, other):
+        "Returns the expression of the set `other` used as an operand."
+        if other._object_class is not self._object_class:
+            raise TypeError("Only sets of '{0}' objects are supported"
+                            .format(self._object_class.__name__))
+        return other._expression()
+
+    def _members_version_key(self):
+        "Returns the cache key of the version of the members of this set."
+        opts = self._meta
+        return 'objectset:{0}.{1}:{2}:version'.format(
+            opts.app_label, opts.object_name.lower(), self.pk)
+
+    def _members_cache_key(self):
+        """Returns the cache key of the members of this set at its current
+        version. A missing version starts from the current time so the
+        members cached under an evicted version are not used again.
         """
-        # Not defined, so it is assumed to only have one M2M field
-        if not hasattr(self, 'set_object_rel'):
-            m2m_fields = self._meta.many_to_many
-
-            if not m2m_fields:
-                raise ImproperlyConfigured('At least one many-to-many '
-                                           'relationship must exist on object '
-                                           'sets.')
+        cache = get_cache(self.members_cache)
+        key = self._members_version_key()
+        version = cache.get(key)
 
-            if len(m2m_fields) != 1:
-                raise ImproperlyConfigured('No explicit set object relation '
-                                           'has been defined, but more than '
-                                           'one many-to-many relationship '
-                                           'exists on this object set. Define '
-                                           '`set_object_rel` name on the '
-                                           'class.')
+        if version is None:
+            cache.add(key, int(time.time() * 1000000))
+            version = cache.get(key)
 
-            self.set_object_rel = m2m_fields[0].name
+        return '{0}:{1}'.format(key, version)
 
-        return self.set_object_rel
+    def _cached_pks(self, load=True):
+        """Returns a `PKSet` of the objects in this set from the members
+        cache, or None if it is not enabled, this set is not saved or has
+        pending objects or is too large to be cached.
 
-    @cached_property
-    def _through_set_rel(self):
-        """Returns the name of the relation on the through model that goes to
-        the set, e.g. `TeamPlayer.team`
+        If the members are not cached and `load` is true, they are read from
+        the set objects with one query and stored in the cache.
         """
-        through = self._set_object_class
+        if not self.cache_members or not self.pk or self._has_pending():
+            return None
 
-        if hasattr(through, 'object_set_rel'):
-            return through.object_set_rel
+        key = self._members_cache_key()
 
-        field = None
+        if self._members is not None and self._members[0] == key:
+            return self._members[1]
 
-        for f in through._meta.fields:
-            if isinstance(f, models.ForeignKey) and f.rel.to is self.__class__:
-                if field is None:
-                    field = f
-                    continue
+        cache = get_cache(self.members_cache)
+        value = cache.get(key)
+
+        if value is None:
+            if not load or self.count > self.members_cache_max_size:
+                return None
 
-                raise ImproperlyConfigured('No explicit through model set '
-                                           'field relation has been defined, '
-                                           'but more than one exists.')
+            pks = PKSet(self._set_objects(**self._member_kwargs())
+                        .values_list('{0}__pk'
+                                     .format(self._through_object_rel),
+                                     flat=True).iterator())
+            value = pks.dumps()
 
-        if field is None:
-            raise ImproperlyConfigured('No through model set field relation '
-                                       'was found.')
+            # Store an empty value for sets too large to be cached so they
+            # are not read again
+            if len(value) > self.members_cache_max_bytes:
+                cache.set(key, '', self.members_cache_timeout)
+                return pks
 
-        return field.name
+            cache.set(key, value, self.members_cache_timeout)
 
-    @cached_property
-    def _through_object_rel(self):
-        """Returns the name of the relation on the through model that goes to
-        the object, e.g. TeamPlayer.player
+        elif not value:
+            return None
+
+        else:
+            pks = PKSet.loads(value)
+
+        self._members = (key, pks)
+        return pks
+
+    def _invalidate_members(self):
+        """Increments the version of the cached members of this set when it
+        is changed, which invalidates them for all instances.
+        """
+        if self.cache_members and self.pk:
+            try:
+                get_cache(self.members_cache)\
+                    .incr(self._members_version_key())
+            except ValueError:
+                # Not cached, so no members are cached under it either
+                pass
+
+        self._members = None
+
+    def _from_cached(self, other, operation):
+        """Returns a new set with the objects resulting from `operation` on
+        the cached members of this set and `other`, or None if either is not
+        cached. The result is only used if it is small enough to be filtered
+        by in a single query.
         """
-        through = self._set_object_class
+        if not isinstance(other, ObjectSet):
+            return None
 
-        if hasattr(through, 'set_object_rel'):
-            return through.object_set_rel
+        a = self._cached_pks(load=False)
 
-        field = None
+        if a is None:
+            return None
 
-        for f in through._meta.fields:
-            if isinstance(f, models.ForeignKey) and \
-                    f.rel.to is self._object_class:
-                if field is None:
-                    field = f
-                    continue
+        b = other._cached_pks(load=False)
+
+        if b is None or other._object_class is not self._object_class:
+            return None
+
+        pks = operation(a, b)
 
-                raise ImproperlyConfigured('No explicit through model object '
-                                           'field relation has been defined, '
-                                           'but more than one exists.')
+        if len(pks) > BATCH_SIZE:
+            return None
 
-        if field is None:
-            raise ImproperlyConfigured('No through model object field '
-                                       'relation was found.')
+        instance = self.__class__()
 
-        return field.name
+        if len(pks):
+            instance._pending = self._object_class.objects\
+                .filter(pk__in=list(pks))
 
-    @cached_property
-    def _set_object_class(self):
-        "The class of the through model, e.g. TeamPlayer"
-        return getattr(self.__class__, self._set_object_rel).through
+        return instance
 
-    @cached_property
-    def _object_class(self):
-        "The class of the object model, e.g. Player"
-        return getattr(self.__class__, self._set_object_rel).field.rel.to
+    def _pending_expression(self):
+        "Returns the expression of the pending objects."
+        pending = self._pending_objects
+
+        if self._compiled is not None and self._compiled[1] is pending:
+            return self._compiled[0]
+        return QuerySetLeaf.for_queryset(pending)
+
+    def _expression(self):
+        """Returns the expression of the objects in this set including
+        pending ones.
+        """
+        if not self.pk:
+            return self._pending_expression()
+        return SetLeaf(self) | self._pending_expression()
+
+    def _set_pending_expression(self, expression):
+        "Compiles `expression` into the pending queryset."
+        self._pending = compile_queryset(expression, self._object_class)
+        self._compiled = (expression, self._pending)
+
+    def _from_expression(self, expression):
+        "Returns a new set of this class with `expression` pending."
+        instance = self.__class__()
+        instance._set_pending_expression(expression)
+        return instance
+
+    @classmethod
+    def at_least(cls, sets, minimum):
+        """Returns a new set of the objects contained in at least `minimum`
+        of the `sets` given as instances or primary keys of this class. The
+        objects are selected with a single grouped query of the set objects
+        and are pending until the set is saved.
+        """
+        pks = _set_pks(sets, cls)
 
-    @cached_property
-    def _set_object_class_supported(self):
-        """Returns true if the set object class subclasses SetObject for
-        extended features.
+        if pks and minimum <= len(pks):
+            expression = CountLeaf(cls, pks, minimum)
+        else:
+            expression = EMPTY
+
+        instance = cls()
+        instance._set_pending_expression(expression)
+        return instance
+
+    @classmethod
+    def union_all(cls, sets):
+        "Returns a new set of the objects contained in any of the `sets`."
+        return cls.at_least(sets, 1)
+
+    @classmethod
+    def intersection_all(cls, sets):
+        "Returns a new set of the objects contained in all of the `sets`."
+        return cls.at_least(sets, len(_set_pks(sets, cls)))
+
+    def overlap(self, other):
+        """Returns statistics of the overlap of this set and `other` which
+        are computed with a single aggregate query:
+
+            - `size` and `other_size`, the sizes of the sets
+            - `intersection` and `union`, the sizes of their intersection
+              and union
+            - `jaccard`, the size of the intersection over the union
+            - `containment` and `other_containment`, the fraction of this set
+              contained in `other` and vice versa
+
+        Ratios with an empty denominator are 0.
+        """
+        model = self._object_class
+        connection = connections[router.db_for_read(model)]
+        qn = connection.ops.quote_name
+
+        table = qn(model._meta.db_table)
+        column = '{0}.{1}'.format(table, qn(model._meta.pk.column))
+
+        predicates = []
+        params = []
+
+        for expression in (self._expression(), self._operand(other)):
+            if expression == EMPTY:
+                predicates.append('1 = 0')
+                continue
+
+            sql, _params = ExpressionSubquery(expression, model)\
+                ._as_sql(connection)
+            predicates.append('{0} IN ({1})'.format(column, sql))
+            params.extend(_params)
+
+        sql = 'SELECT COUNT(*), SUM(U.a), SUM(U.b) FROM (' \
+            'SELECT CASE WHEN {0} THEN 1 ELSE 0 END AS a, ' \
+            'CASE WHEN {1} THEN 1 ELSE 0 END AS b ' \
+            'FROM {2} WHERE {0} OR {1}) U'.format(predicates[0],
+                                                  predicates[1], table)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params * 2)
+        union, size, other_size = [int(x or 0) for x in cursor.fetchone()]
+        intersection = size + other_size - union
+
+        def ratio(n, d):
+            return n / float(d) if d else 0.0
+
+        return {
+            'size': size,
+            'other_size': other_size,
+            'intersection': intersection,
+            'union': union,
+            'jaccard': ratio(intersection, union),
+            'containment': ratio(intersection, size),
+            'other_containment': ratio(intersection, other_size),
+        }
+
+    @classmethod
+    def overlap_matrix(cls, sets):
+        """Returns a matrix, as a list of lists, of the intersection sizes
+        of every pair of `sets` given as instances or primary keys of this
+        class. The diagonal contains the sizes of the sets. All sizes are
+        computed with a single self-join of the set objects.
         """
-        return issubclass(self._set_object_class, SetObject)
+        pks = [_set_pk(s, cls) for s in sets]
+
+        if not pks:
+            return []
+
+        connection = connections[router.db_for_read(cls._set_object_class)]
+
+        table, a_set, a_object, a_where, a_params = \
+            cls._set_object_sql(connection, alias='A')
+        table, b_set, b_object, b_where, b_params = \
+            cls._set_object_sql(connection, alias='B')
+
+        placeholders = ', '.join(['%s'] * len(pks))
+
+        where = [
+            '{0} IN ({1})'.format(a_set, placeholders),
+            '{0} IN ({1})'.format(b_set, placeholders),
+            '{0} <= {1}'.format(a_set, b_set),
+        ]
+
+        sql = 'SELECT {0}, {1}, COUNT(*) FROM {2} {3} INNER JOIN {2} {4} ' \
+            'ON {5} = {6} WHERE {7} GROUP BY {0}, {1}'.format(
+                a_set, b_set, table, connection.ops.quote_name('A'),
+                connection.ops.quote_name('B'), a_object, b_object,
+                ' AND '.join(where + a_where + b_where))
+
+        cursor = connection.cursor()
+        cursor.execute(sql, pks + pks + a_params + b_params)
+
+        counts = {}
+        for a, b, count in cursor.fetchall():
+            counts[(a, b)] = counts[(b, a)] = count
+
+        return [[counts.get((a, b), 0) for b in pks] for a in pks]
 
     def _objects(self):
         "Returns a QuerySet of objects in this set including pending ones."
         if not self.pk:
             return self._pending
 
-        kwargs = {}
+        if not self._has_pending():
+            objects = self._member_objects()
 
-        if self._set_object_class_supported:
-            kwargs['removed'] = False
+            if objects is not None:
+                return objects
 
         objects = self._object_class.objects.all()
-        pks = self._set_objects(**kwargs)\
+        pks = self._set_objects(**self._member_kwargs())\
             .values_list('{0}__pk'.format(self._through_object_rel))
 
         return objects.filter(pk__in=pks) | self._pending
 
+    @classmethod
+    def _unique_set_objects(cls):
+        """Returns true if the set object class is unique on the set and
+        object columns, so there is at most one set object per object.
+        """
+        opts = cls._set_object_class._meta
+        together = opts.unique_together
+
+        # Django 1.4 does not normalize a single tuple of field names
+        if together and isinstance(together[0], basestring):
+            together = (together,)
+
+        columns = set([cls._through_set_rel, cls._through_object_rel])
+
+        return bool([t for t in together if set(t) == columns])
+
+    def _member_objects(self):
+        """Returns a QuerySet of the objects in this saved set joined with
+        the set objects rather than filtered by a subquery, or None if the
+        relations cannot be queried from the object model, e.g. they are
+        hidden with a `+` related name, or the set object class is not
+        unique on the set and object, in which case the join would repeat
+        objects.
+
+        If `insertion_order` is true, the objects are ordered by the primary
+        key of their set objects.
+        """
+        if not self._unique_set_objects():
+            return None
+
+        objects = self._object_class.objects.all()
+        fk = self._set_object_class._meta.get_field(self._through_object_rel)
+
+        # Filter the set objects in one call so they are joined once
+        if not fk.rel.is_hidden():
+            name = fk.related_query_name()
+            lookups = {'{0}__{1}'.format(name, self._through_set_rel): self.pk}
+
+            for key, value in self._member_kwargs().items():
+                lookups['{0}__{1}'.format(name, key)] = value
+
+            objects = objects.filter(**lookups)
+
+            if self.insertion_order:
+                objects = objects.order_by('{0}__pk'.format(name))
+
+            return objects
+
+        # The reverse relation of auto-created through models is hidden,
+        # but they do not have flags so the many-to-many relation is used
+        m2m = self._meta.get_field(self._set_object_rel)
+
+        if m2m.rel.is_hidden() or self._member_kwargs():
+            return None
+
+        objects = objects.filter(**{m2m.related_query_name(): self.pk})
+
+        if self.insertion_order:
+            opts = self._set_object_class._meta
+            qn = connections[objects.db].ops.quote_name
+            objects = objects.extra(order_by=['{0}.{1}'.format(
+                qn(opts.db_table), qn(opts.pk.column))])
+
+        return objects
+
+    @classmethod
+    def sets_for_objects(cls, objs, memo=None):
+        """Returns a dict of the primary keys of `objs`, objects or primary
+        keys, to a sorted list of the primary keys of the sets of this class
+        containing them. The set objects are read with one query per batch
+        of objects.
+
+        `memo` is an optional dict, e.g. stored on the request, in which the
+        results are kept per set class so repeated lookups of the same
+        objects do not query the database.
+        """
+        pks = list(cls._iter_pks(objs, allow_pks=True))
+
+        if memo is not None:
+            memo = memo.setdefault(cls, {})
+            result = dict([(pk, memo[pk]) for pk in pks if pk in memo])
+        else:
+            result = {}
+
+        unknown = [pk for pk in pks if pk not in result]
+
+        for pk in unknown:
+            result[pk] = []
+
+        set_rel = cls._through_set_rel
+        object_rel = cls._through_object_rel
+        lookup = '{0}__in'.format(object_rel)
+
+        for chunk in _chunked(set(unknown), BATCH_SIZE):
+            lookups = cls._member_kwargs()
+            lookups[lookup] = chunk
+
+            queryset = cls._set_object_class.objects.filter(**lookups)\
+                .order_by(set_rel).values_list(object_rel, set_rel)
+
+            for pk, set_pk in queryset:
+                result[pk].append(set_pk)
+
+        if memo is not None:
+            for pk in unknown:
+                memo[pk] = result[pk]
+
+        return result
+
+    @classmethod
+    def _member_kwargs(cls):
+        """Returns the filters for set objects of objects currently in the
+        set, i.e. excluding the ones marked as `removed`.
+        """
+        if cls._set_object_class_supported:
+            return {'removed': False}
+        return {}
+
+    @classmethod
+    def _set_object_sql(cls, connection, alias=None):
+        """Returns the quoted table, set column and object column of the set
+        object class, and the where clauses and parameters limiting it to the
+        objects currently in a set. The columns are qualified with `alias`
+        if given, otherwise with the table.
+        """
+        opts = cls._set_object_class._meta
+        qn = connection.ops.quote_name
+
+        table = qn(opts.db_table)
+        ref = qn(alias) if alias else table
+
+        set_column = '{0}.{1}'.format(
+            ref, qn(opts.get_field(cls._through_set_rel).column))
+        object_column = '{0}.{1}'.format(
+            ref, qn(opts.get_field(cls._through_object_rel).column))
+
+        where = []
+        params = []
+
+        for name, value in cls._member_kwargs().items():
+            field = opts.get_field(name)
+            where.append('{0}.{1} = %s'.format(ref, qn(field.column)))
+            params.append(field.get_db_prep_value(value, connection))
+
+        return table, set_column, object_column, where, params
+
     def _set_objects(self, **kwargs):
         """Returns a queryset of set objects. Keyword arguments are passed as
         filters the set objects queryset.
@@ -290,13 +1039,21 @@ class ObjectSet(models.Model):
             pass
 
     def _set_object_exists(self, obj, **kwargs):
-        "Returns a boolean if the object is contained in this set."
+        """Returns a boolean if the object, or object primary key, is
+        contained in this set.
+        """
         kwargs[self._through_object_rel] = obj
         return self._set_objects(**kwargs).exists()
 
     def _make_set_object(self, obj, **defaults):
-        "Makes a new set object."
-        kwargs = {self._through_object_rel: obj, self._through_set_rel: self}
+        "Makes a new set object for an object or an object primary key."
+        if isinstance(obj, models.Model):
+            key = self._through_object_rel
+        else:
+            key = self._set_object_class._meta\
+                .get_field(self._through_object_rel).attname
+
+        kwargs = {key: obj, self._through_set_rel: self}
         kwargs.update(defaults)
         return self._set_object_class(**kwargs)
 
@@ -304,10 +1061,24 @@ class ObjectSet(models.Model):
         if not self.pk:
             raise ObjectSetError
 
-    def _check_type(self, obj):
-        if not isinstance(obj, self._object_class):
+    @classmethod
+    def _check_type(cls, obj):
+        if not isinstance(obj, cls._object_class):
             raise TypeError("Only objects of type '{0}' can be added to the "
-                            "set".format(self._object_class.__name__))
+                            "set".format(cls._object_class.__name__))
+
+    @classmethod
+    def _iter_pks(cls, objs, allow_pks=False):
+        """Checks the type of each object and yields its primary key. If
+        `allow_pks` is true, values that are not model instances are assumed
+        to be primary keys.
+        """
+        for obj in iter(objs):
+            if allow_pks and not isinstance(obj, models.Model):
+                yield obj
+                continue
+            cls._check_type(obj)
+            yield obj.pk
 
     def _add(self, obj, added):
         """Check for an existing object that has been removed and mark
@@ -315,26 +1086,603 @@ class ObjectSet(models.Model):
         as added.
         """
         self._check_type(obj)
+        return self._add_many([obj.pk], added) == 1
 
-        _obj = self._get_set_object(obj)
+    def _add_many(self, pks, added, ignore_conflicts=False):
+        """Adds the objects for `pks` that are not already in the set.
 
-        if not self._set_object_class_supported:
-            if _obj:
-                return False
-            _obj = self._make_set_object(obj)
+        The primary keys are processed in batches. For each batch, the
+        existing set objects are fetched in one query, the ones marked as
+        `removed` are restored in one update and the remaining set objects
+        are bulk created. If `ignore_conflicts` is true, existing set
+        objects are not fetched and are skipped by the database on insert
+        instead. Returns the number of objects added.
+        """
+        lookup = '{0}__in'.format(self._through_object_rel)
+        value = '{0}__pk'.format(self._through_object_rel)
+        count = 0
+
+        for chunk in _chunked(pks, BATCH_SIZE):
+            self._update_sketches(chunk)
+
+            if ignore_conflicts:
+                count += self._add_ignore_conflicts(chunk, added)
+                continue
+
+            existing = self._set_objects(**{lookup: chunk})
+            restore = []
+
+            if self._set_object_class_supported:
+                present = set()
+
+                for pk, removed in existing.values_list(value, 'removed'):
+                    present.add(pk)
+                    if removed:
+                        restore.append(pk)
+
+                if restore:
+                    self._set_objects(**{lookup: restore})\
+                        .update(removed=False, added=added)
+            else:
+                present = set(existing.values_list(value, flat=True))
+
+            _objs = []
+
+            for pk in chunk:
+                if pk in present:
+                    continue
+
+                # Guards against duplicates in the input
+                present.add(pk)
+                _obj = self._make_set_object(pk)
+                if self._set_object_class_supported:
+                    _obj.added = added
+                _objs.append(_obj)
+
+            if _objs:
+                if BULK_SUPPORTED:
+                    self._set_object_class.objects.bulk_create(_objs)
+                else:
+                    for _obj in _objs:
+                        _obj.save()
+
+            count += len(restore) + len(_objs)
+
+        return count
+
+    def _add_ignore_conflicts(self, pks, added):
+        """Adds the objects for `pks` without checking for existing set
+        objects first. Removed set objects are restored and the others are
+        inserted, skipping the ones already in the set. This requires a
+        unique constraint on the set and object columns of the set object
+        class. Returns the number of objects added.
+        """
+        if not self._unique_set_objects():
+            raise ImproperlyConfigured('Ignoring conflicts requires the set '
+                                       'object class {0} to be unique on the '
+                                       'set and object with `unique_together`'
+                                       .format(self._set_object_class
+                                               .__name__))
+
+        count = 0
+
+        if self._set_object_class_supported:
+            lookup = '{0}__in'.format(self._through_object_rel)
+            count += self._set_objects(removed=True, **{lookup: pks})\
+                .update(removed=False, added=added)
+            count += self._insert_ignore_conflicts(pks, added=added)
+        else:
+            count += self._insert_ignore_conflicts(pks)
+
+        return count
+
+    def _set_object_fields(self, connection, **defaults):
+        """Returns the fields of the set object class to insert and the
+        parameters for all but the set and object fields. `defaults` are
+        values for the remaining fields, otherwise the field defaults are used.
+
+        The values are prepared by the fields as for a new instance, so
+        fields such as `auto_now_add` date fields are set.
+        """
+        opts = self._set_object_class._meta
+        set_field = opts.get_field(self._through_set_rel)
+        object_field = opts.get_field(self._through_object_rel)
+
+        template = self._set_object_class(**defaults)
+
+        fields = [set_field, object_field]
+        params = []
+
+        for field in opts.local_fields:
+            if field.primary_key or field in (set_field, object_field):
+                continue
+            value = field.pre_save(template, True)
+            fields.append(field)
+            params.append(field.get_db_prep_save(value, connection))
+
+        return fields, params
+
+    def _insert_from_queryset(self, queryset, **defaults):
+        """Inserts set objects for the objects in `queryset` using a single
+        `INSERT ... SELECT` statement so the objects never need to be loaded.
+        `defaults` are values for the remaining fields on the set object
+        class, otherwise the field defaults are used. Returns the number of
+        set objects inserted.
+
+        Sliced querysets are selected as is with their ordering, since the
+        ordering and distinct rows of a sliced query cannot be changed.
+        """
+        if queryset.model is not self._object_class:
+            raise TypeError("Only objects of type '{0}' can be added to the "
+                            "set".format(self._object_class.__name__))
+
+        using = router.db_for_write(self._set_object_class)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+
+        fields, params = self._set_object_fields(connection, **defaults)
+        values = ['%s', 'U.{0}'.format(qn(self._object_class._meta.pk.column))]
+        values.extend(['%s'] * len(params))
+
+        if queryset.query.can_filter():
+            queryset = queryset.order_by().values_list('pk', flat=True)\
+                .distinct()
+        else:
+            queryset = queryset.values_list('pk', flat=True)
+
+        try:
+            subquery, subparams = queryset.query\
+                .get_compiler(using=using).as_sql()
+        except EmptyResultSet:
+            return 0
+
+        sql = 'INSERT INTO {0} ({1}) SELECT {2} FROM ({3}) U'.format(
+            qn(self._set_object_class._meta.db_table),
+            ', '.join([qn(f.column) for f in fields]), ', '.join(values),
+            subquery)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, [self.pk] + params + list(subparams))
+        transaction.set_dirty(using=using)
+
+        return cursor.rowcount
+
+    def _insert_ignore_conflicts(self, pks, **defaults):
+        """Inserts set objects for `pks` with statements which skip rows
+        violating a unique constraint of the set object class, such as
+        objects already in the set. The rows are split into as few
+        statements as the parameter limit of the backend allows. Returns the
+        number of set objects inserted.
+        """
+        using = router.db_for_write(self._set_object_class)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+
+        if connection.vendor == 'sqlite':
+            template = 'INSERT OR IGNORE INTO {0} ({1}) {2}'
+        elif connection.vendor == 'mysql':
+            template = 'INSERT IGNORE INTO {0} ({1}) {2}'
+        elif connection.vendor == 'postgresql':
+            template = 'INSERT INTO {0} ({1}) {2} ON CONFLICT DO NOTHING'
+        else:
+            raise NotImplementedError('Ignoring conflicts is not supported '
+                                      'by the {0} backend'
+                                      .format(connection.vendor))
+
+        fields, params = self._set_object_fields(connection, **defaults)
+
+        pks = list(pks)
+        if not pks:
+            return 0
+
+        # Django 1.4 does not define the batch size of the backend
+        if hasattr(connection.ops, 'bulk_batch_size'):
+            batch_size = connection.ops.bulk_batch_size(fields, pks)
+        else:
+            batch_size = len(pks)
+
+        cursor = connection.cursor()
+        count = 0
+
+        for chunk in _chunked(pks, max(batch_size, 1)):
+            sql = template.format(
+                qn(self._set_object_class._meta.db_table),
+                ', '.join([qn(f.column) for f in fields]),
+                connection.ops.bulk_insert_sql(fields, len(chunk)))
+
+            values = []
+            for pk in chunk:
+                values.extend([self.pk, pk])
+                values.extend(params)
+
+            cursor.execute(sql, values)
+            count += cursor.rowcount
+
+        transaction.set_dirty(using=using)
+
+        return count
+
+    def _remove_many(self, objs, delete=False):
+        """Removes the objects in `objs` from the set which can be an
+        iterable of objects or primary keys, a queryset or another set.
+
+        Querysets and sets are removed with a single filtered update or
+        delete, iterables are processed in batches. Set objects are marked
+        as `removed` unless `delete` is true or the set object class is not
+        supported in which case they are deleted. Returns the number of
+        objects removed.
+        """
+        lookup = '{0}__in'.format(self._through_object_rel)
+
+        if isinstance(objs, ObjectSet):
+            objs = objs.objects
+
+        if isinstance(objs, QuerySet):
+            if objs.model is not self._object_class:
+                raise TypeError("Only objects of type '{0}' can be removed "
+                                "from the set"
+                                .format(self._object_class.__name__))
+            if objs.query.can_filter():
+                objs = objs.order_by()
+            batches = [_PKSubquery(objs.values('pk'))]
         else:
-            if _obj:
-                # Already exists, nothing to do
-                if not _obj.removed:
-                    return False
-                _obj.removed = False
-                _obj.added = added
+            batches = _chunked(self._iter_pks(objs, allow_pks=True),
+                               BATCH_SIZE)
+
+        count = 0
+
+        for batch in batches:
+            _objs = self._set_objects(**{lookup: batch})
+
+            if delete or not self._set_object_class_supported:
+                # Removed set objects are deleted as well, but only
+                # the objects still in the set affect the count.
+                if self._set_object_class_supported:
+                    count += _objs.filter(removed=False).count()
+                else:
+                    count += _objs.count()
+                _objs.delete()
             else:
-                _obj = self._make_set_object(obj, added=added)
+                count += _objs.filter(removed=False).update(removed=True)
+
+        return count
+
+    def _get_hll(self):
+        "Returns the HyperLogLog sketch of this set."
+        if not self.hll_field:
+            raise ImproperlyConfigured('{0} does not define a sketch field '
+                                       'with `hll_field`'
+                                       .format(self.__class__.__name__))
+
+        value = getattr(self, self.hll_field)
+        if value:
+            return HyperLogLog.loads(value)
+        return HyperLogLog(self.hll_precision)
+
+    def _get_minhash(self):
+        "Returns the MinHash signature of this set."
+        if not self.minhash_field:
+            raise ImproperlyConfigured('{0} does not define a signature '
+                                       'field with `minhash_field`'
+                                       .format(self.__class__.__name__))
+
+        value = getattr(self, self.minhash_field)
+        if value:
+            return MinHash.loads(value)
+        return MinHash(self.minhash_permutations)
+
+    def _update_sketches(self, pks):
+        "Adds `pks` to the sketches of this set, if enabled."
+        if not self.hll_field and not self.minhash_field:
+            return
+
+        pks = list(pks)
+        self._sketches_changed = True
+
+        if self.hll_field:
+            hll = self._get_hll()
+            hll.update(pks)
+            setattr(self, self.hll_field, hll.dumps())
+
+        if self.minhash_field:
+            minhash = self._get_minhash()
+            minhash.update(pks)
+            setattr(self, self.minhash_field, minhash.dumps())
+
+    def _reset_sketches(self):
+        "Resets the sketches of this set to empty ones."
+        self._sketches_reset = True
+
+        if self.hll_field:
+            setattr(self, self.hll_field,
+                    HyperLogLog(self.hll_precision).dumps())
+
+        if self.minhash_field:
+            setattr(self, self.minhash_field,
+                    MinHash(self.minhash_permutations).dumps())
+
+    def _rebuild_sketches(self):
+        "Rebuilds the sketches of this set from the objects in the set."
+        if not self.hll_field and not self.minhash_field:
+            return
+
+        self._reset_sketches()
+        self._update_sketches(self.pks())
+
+    @transaction.commit_on_success
+    def rebuild_sketches(self):
+        """Rebuilds and saves the sketches of this set from the objects in
+        the set, e.g. to reflect removed objects. Only the sketch columns
+        are written so concurrent changes of the count are not lost.
+        """
+        self._check_pk()
+        self._rebuild_sketches()
 
-        _obj.save()
+        values = {}
 
-        return True
+        for name in (self.hll_field, self.minhash_field):
+            if name:
+                values[name] = getattr(self, name)
+
+        if values:
+            self.__class__._default_manager.filter(pk=self.pk)\
+                .update(**values)
+
+        self._sketches_changed = self._sketches_reset = False
+
+        if self.minhash_field:
+            self._save_bands()
+
+    def _merge_stored_sketches(self):
+        """Merges the stored sketches of this set into the ones of this
+        instance. The row of the set is locked until the end of the
+        transaction so the merged sketches are written before another
+        writer reads them.
+        """
+        names = [n for n in (self.hll_field, self.minhash_field) if n]
+
+        stored = self.__class__._default_manager.select_for_update()\
+            .filter(pk=self.pk).values_list(*names)
+
+        for values in stored:
+            for name, value in zip(names, values):
+                if not value:
+                    continue
+
+                if name == self.hll_field:
+                    merged = self._get_hll().union(HyperLogLog.loads(value))
+                else:
+                    merged = self._get_minhash()\
+                        .union(MinHash.loads(value))
+
+                setattr(self, name, merged.dumps())
+
+    def approx_count(self):
+        "Returns the estimated size of this set using its sketch."
+        return self._get_hll().count()
+
+    def approx_union(self, other):
+        "Returns the estimated size of the union of this set and `other`."
+        return self._get_hll().union(other._get_hll()).count()
+
+    def approx_intersection(self, other):
+        """Returns the estimated size of the intersection of this set and
+        `other` by inclusion-exclusion of the estimated sizes.
+        """
+        size = self.approx_count()
+        other_size = other.approx_count()
+        union = self.approx_union(other)
+        return max(0, min(size + other_size - union, size, other_size))
+
+    def similarity(self, other):
+        """Returns the estimated Jaccard similarity of this set and `other`
+        using their MinHash signatures.
+        """
+        return self._get_minhash().jaccard(other._get_minhash())
+
+    @classmethod
+    def _band_label(cls):
+        "Returns the label of this class for its signature bands."
+        opts = cls._meta.concrete_model._meta
+        return '{0}.{1}'.format(opts.app_label, opts.object_name)
+
+    def _save_bands(self):
+        "Replaces the stored bands of the MinHash signature of this set."
+        label = self._band_label()
+
+        SignatureBand.objects.filter(set_model=label, set_pk=self.pk)\
+            .delete()
+
+        minhash = self._get_minhash()
+
+        if minhash.is_empty():
+            return
+
+        bands = [SignatureBand(set_model=label, set_pk=self.pk, band=band,
+                               hash=h)
+                 for band, h in band_hashes(minhash, self.minhash_bands)]
+
+        if BULK_SUPPORTED:
+            SignatureBand.objects.bulk_create(bands)
+        else:
+            for band in bands:
+                band.save()
+
+    @classmethod
+    def similar_to(cls, instance, k=10):
+        """Returns up to `k` sets of this class most similar to `instance` as
+        a list of (set, estimated Jaccard similarity) pairs, most similar
+        first.
+
+        The bands of the signatures are stored in the indexed table of
+        `SignatureBand` by locality-sensitive hashing, so only the signatures
+        of the sets sharing a band with the signature of `instance` are read
+        and scored.
+        """
+        minhash = instance._get_minhash()
+
+        if minhash.is_empty():
+            return []
+
+        hashes = [h for _, h in band_hashes(minhash, cls.minhash_bands)]
+
+        candidates = SignatureBand.objects\
+            .filter(set_model=cls._band_label(), hash__in=hashes)\
+            .values('set_pk')
+
+        queryset = cls._default_manager.filter(pk__in=candidates)\
+            .exclude(pk=instance.pk).values_list('pk', cls.minhash_field)
+
+        scores = []
+
+        for pk, value in queryset.iterator():
+            if value:
+                scores.append((minhash.jaccard(MinHash.loads(value)), pk))
+
+        scores.sort(reverse=True)
+        scores = scores[:k]
+
+        instances = cls._default_manager.in_bulk([pk for _, pk in scores])
+
+        return [(instances[pk], score) for score, pk in scores]
+
+    def pks(self):
+        """Returns an iterator of the primary keys of the objects in this set.
+        For saved sets without pending objects, the primary keys are read
+        from the set objects only.
+        """
+        if not self.pk or self._has_pending():
+            return self.objects.values_list('pk', flat=True).iterator()
+
+        pks = self._cached_pks()
+
+        if pks is not None:
+            return iter(pks)
+
+        return self._set_objects(**self._member_kwargs())\
+            .values_list('{0}__pk'.format(self._through_object_rel),
+                         flat=True).iterator()
+
+    def pkset(self):
+        """Returns a `PKSet` of the primary keys of the objects in this set
+        for performing set operations in memory.
+        """
+        pks = self._cached_pks()
+
+        if pks is not None:
+            return pks
+
+        return PKSet(self.pks())
+
+    @classmethod
+    @transaction.commit_on_success
+    def from_pks(cls, pks, **kwargs):
+        """Creates a set containing the objects for `pks`, such as a `PKSet`,
+        which are loaded using `bulk`. `kwargs` are passed to the set
+        constructor.
+        """
+        instance = cls(**kwargs)
+        instance.save()
+        instance.bulk(pks)
+        return instance
+
+    def to_array(self, chunk_size=ARRAY_CHUNK_SIZE):
+        """Returns a sorted int64 NumPy array of the primary keys of the
+        objects in this set. For saved sets, the set objects are read in
+        chunks of `chunk_size` ordered by their primary key.
+        """
+        numpy = _import_numpy()
+
+        if not self.pk or self._has_pending():
+            return numpy.sort(numpy.fromiter(self.pks(), dtype=numpy.int64))
+
+        queryset = self._set_objects(**self._member_kwargs())\
+            .values_list('pk', '{0}__pk'.format(self._through_object_rel))\
+            .order_by('pk')
+
+        chunks = []
+        last = None
+
+        while True:
+            if last is None:
+                rows = list(queryset[:chunk_size])
+            else:
+                rows = list(queryset.filter(pk__gt=last)[:chunk_size])
+
+            if not rows:
+                break
+
+            chunks.append(numpy.array([pk for _, pk in rows],
+                                      dtype=numpy.int64))
+            last = rows[-1][0]
+
+            if len(rows) < chunk_size:
+                break
+
+        if not chunks:
+            return numpy.empty(0, dtype=numpy.int64)
+
+        return numpy.sort(numpy.concatenate(chunks))
+
+    def dump_npy(self, path, chunk_size=ARRAY_CHUNK_SIZE):
+        """Writes the array of primary keys returned by `to_array` to `path`
+        in the NumPy `.npy` format.
+        """
+        numpy = _import_numpy()
+        numpy.save(path, self.to_array(chunk_size=chunk_size))
+
+    @staticmethod
+    def load_npy(path, mmap_mode='r'):
+        """Loads an array of primary keys written by `dump_npy`. By default
+        the file is memory-mapped read-only rather than read into memory.
+        """
+        numpy = _import_numpy()
+        return numpy.load(path, mmap_mode=mmap_mode)
+
+    @classmethod
+    def from_array(cls, array, **kwargs):
+        """Creates a set containing the objects for the primary keys in
+        `array`, such as one returned by `to_array` or `load_npy`. `kwargs`
+        are passed to the set constructor.
+        """
+        return cls.from_pks((int(pk) for pk in array), **kwargs)
+
+    def contains_many(self, objs):
+        """Returns a dict of primary key to a boolean of whether the object
+        is in this set for each object or object primary key in `objs`.
+        Membership is determined with one query per batch of objects.
+        """
+        pks = list(self._iter_pks(objs, allow_pks=True))
+        members = self._cached_pks()
+
+        if members is not None:
+            return dict([(pk, pk in members) for pk in pks])
+
+        contained = {}
+
+        if self.cache_membership and self._membership is not None:
+            for pk in pks:
+                if pk in self._membership:
+                    contained[pk] = self._membership[pk]
+
+        lookup = '{0}__in'.format(self._through_object_rel)
+        value = '{0}__pk'.format(self._through_object_rel)
+        unknown = [pk for pk in pks if pk not in contained]
+
+        for chunk in _chunked(unknown, BATCH_SIZE):
+            members = set(self._set_objects(**dict(self._member_kwargs(),
+                                                   **{lookup: chunk}))
+                          .values_list(value, flat=True))
+
+            for pk in chunk:
+                contained[pk] = pk in members
+
+        if self.cache_membership:
+            if self._membership is None:
+                self._membership = {}
+            self._membership.update(contained)
+
+        return contained
 
     @property
     def added(self):
@@ -364,45 +1712,148 @@ class ObjectSet(models.Model):
 
     @transaction.commit_on_success
     def save(self, *args, **kwargs):
-        # If this is new, use bulk if supported
         new = self.pk is None
         super(ObjectSet, self).save(*args, **kwargs)
 
-        # Handle pending data after the set has been saved
-        if self._pending is not None \
-                and not isinstance(self._pending, EmptyQuerySet):
-            pending = list(self._pending.only('pk'))
-            self._pending = self._object_class.objects.none()
-            if new and BULK_SUPPORTED:
-                self.bulk(pending)
+        # The set may have changed
+        self._membership = None
+
+        # Handle pending data after the set has been saved, unless only some
+        # fields are saved, e.g. the count
+        if self._has_pending() and not kwargs.get('update_fields'):
+            pending = self._pending_objects
+            self._pending_objects = None
+            # If this is new, the pending objects are inserted directly
+            # in the database without loading them
+            if new:
+                count = self._insert_from_queryset(pending)
+                self._rebuild_sketches()
+                self._update_count(count)
             else:
                 self.replace(pending)
 
+    def _update_count(self, delta=0, count=None):
+        """Applies `delta` to the stored count, or sets it to `count`, and
+        updates `modified` after the objects in this set changed.
+
+        The count is incremented in the database, rather than saving the
+        count of this instance, so concurrent changes are not lost. Only the
+        count, `modified` and sketch columns are written and the pending
+        objects are not saved. On Django 1.5 and above, they are written by
+        `save` with `update_fields` so the save signals are sent and
+        overrides of `save` are called, otherwise by a queryset update.
+
+        The sketches are only written if they changed. Added primary keys
+        are merged with the stored sketches under a row lock, so concurrent
+        additions are kept. Reset and rebuilt sketches replace the stored
+        ones, the last writer wins.
+        """
+        self._invalidate_members()
+
+        self.modified = datetime.now()
+        values = {'modified': self.modified}
+
+        if count is None:
+            values['count'] = F('count') + delta
+            self.count += delta
+        else:
+            values['count'] = self.count = count
+
+        sketches = self._sketches_changed or self._sketches_reset
+
+        if sketches:
+            if not self._sketches_reset:
+                self._merge_stored_sketches()
+
+            for name in (self.hll_field, self.minhash_field):
+                if name:
+                    values[name] = getattr(self, name)
+
+            self._sketches_changed = self._sketches_reset = False
+
+        if UPDATE_FIELDS_SUPPORTED:
+            # The count of this instance is the expected count, but the
+            # expression is saved so concurrent changes are not lost
+            count = self.count
+            self.count = values['count']
+
+            try:
+                self.save(update_fields=values.keys())
+            finally:
+                self.count = count
+        else:
+            self.__class__._default_manager.filter(pk=self.pk)\
+                .update(**values)
+
+        if sketches and self.minhash_field:
+            self._save_bands()
+
+        # The set has changed
+        self._membership = None
+
+    def batch(self, added=False, delete=False):
+        """Returns a `SetBatch` for buffering many additions and removals to
+        this set and applying them at once, e.g.
+
+            with bookset.batch() as batch:
+                batch.add(book)
+
+        `added` and `delete` have the same meaning as for `add` and `remove`.
+        """
+        self._check_pk()
+        return SetBatch(self, added=added, delete=delete)
+
     @transaction.commit_on_success
-    def bulk(self, objs, added=False):
+    def bulk(self, objs, added=False, batch_size=BATCH_SIZE, progress=None,
+             ignore_conflicts=False):
         """Attempts to bulk load objects. Although this is the most efficient
         way to add objects, if any fail to be added, none will be added.
 
+        `objs` can be any iterable of objects or object primary keys such as
+        a generator or a flat `values_list` iterator. It is consumed lazily
+        and the set objects are inserted in batches of `batch_size`, so
+        memory usage is proportional to the batch size rather than the
+        input. If `progress` is given, it is called with the number of
+        objects loaded so far after each batch.
+
+        If `ignore_conflicts` is true, objects already in the set and
+        duplicates are skipped by the database rather than failing the load.
+        The returned number then only includes the objects actually added.
+        This requires a unique constraint on the set and object columns of
+        the set object class.
+
         This should be used when the set is empty and needs to be populated.
         """
         if not BULK_SUPPORTED:
             raise EnvironmentError('This method requires Django 1.4 or above')
 
         self._check_pk()
-        _objs = []
         loaded = 0
 
-        for obj in iter(objs):
-            self._check_type(obj)
-            _obj = self._make_set_object(obj)
-            if self._set_object_class_supported:
-                _obj.added = added
-            _objs.append(_obj)
-            loaded += 1
+        for chunk in _chunked(self._iter_pks(objs, allow_pks=True),
+                              batch_size):
+            self._update_sketches(chunk)
+
+            if ignore_conflicts:
+                loaded += self._add_ignore_conflicts(chunk, added)
+            else:
+                _objs = []
+
+                for pk in chunk:
+                    _obj = self._make_set_object(pk)
+                    if self._set_object_class_supported:
+                        _obj.added = added
+                    _objs.append(_obj)
+
+                self._set_object_class.objects.bulk_create(_objs)
+                loaded += len(_objs)
+
+            if progress is not None:
+                progress(loaded)
+
+        if loaded:
+            self._update_count(loaded)
 
-        self._set_object_class.objects.bulk_create(_objs)
-        self.count += loaded
-        self.save()
         return loaded
 
     @transaction.commit_on_success
@@ -411,9 +1862,7 @@ class ObjectSet(models.Model):
         self._check_pk()
         added = self._add(obj, added)
         if added:
-            self.count += 1
-            self.modified = datetime.now()
-            self.save()
+            self._update_count(1)
         return added
 
     @transaction.commit_on_success
@@ -422,33 +1871,43 @@ class ObjectSet(models.Model):
         self._check_pk()
         self._check_type(obj)
 
-        _obj = self._get_set_object(obj)
-        if not _obj:
+        if not self._remove_many([obj.pk], delete=delete):
             return False
 
-        if delete or not self._set_object_class_supported:
-            _obj.delete()
-        else:
-            if _obj.removed:
-                return False
-            _obj.removed = True
-            _obj.save()
-        self.count -= 1
-        self.modified = datetime.now()
-        self.save()
+        self._update_count(-1)
         return True
 
     @transaction.commit_on_success
-    def update(self, objs, added=True):
-        "Update the current set with the objects not already in the set."
+    def remove_many(self, objs, delete=False):
+        """Removes multiple objects from the set. `objs` can be an iterable
+        of objects or primary keys, a queryset or another set. Returns the
+        number of objects removed.
+        """
         self._check_pk()
-        added = 0
-        for obj in iter(objs):
-            added += int(self._add(obj, added))
-        self.count += added
-        self.modified = datetime.now()
-        self.save()
-        return added
+        count = self._remove_many(objs, delete=delete)
+        if count:
+            self._update_count(-count)
+        return count
+
+    def difference_update(self, objs, delete=False):
+        "Alias for `remove_many` following the built-in `set` interface."
+        return self.remove_many(objs, delete=delete)
+
+    @transaction.commit_on_success
+    def update(self, objs, added=True, ignore_conflicts=False):
+        """Update the current set with the objects not already in the set.
+
+        If `ignore_conflicts` is true, objects already in the set are skipped
+        by the database on insert rather than being looked up first. This
+        requires a unique constraint on the set and object columns of the
+        set object class.
+        """
+        self._check_pk()
+        count = self._add_many(self._iter_pks(objs), added,
+                               ignore_conflicts=ignore_conflicts)
+        if count:
+            self._update_count(count)
+        return count
 
     @transaction.commit_on_success
     def clear(self, delete=False):
@@ -459,27 +1918,227 @@ class ObjectSet(models.Model):
             self._set_objects().delete()
         else:
             self._set_objects(removed=False).update(removed=True)
-        self.count = 0
-        self.modified = datetime.now()
-        self.save()
+        self._reset_sketches()
+        self._update_count(count=0)
         return removed
 
     @transaction.commit_on_success
     def replace(self, objs, delete=False, added=True):
-        "Replace the current set with the new objects."
-        self._check_pk()
-        self.clear(delete=delete)
-        # On a real delete, a bulk load is faster
-        if delete or not self._set_object_class_supported:
-            return self.bulk(objs, added=added)
-        return self.update(objs, added=added)
+        """Replace the current set with the new objects.
+
+        Only the difference between the current and the new objects is
+        applied. Objects no longer in the set are removed (or deleted) and
+        new objects are marked as `added`, objects in both are left as is.
+        Returns the size of the set.
 
-    def purge(self):
-        "Deletes objects in the set marked as `removed`."
+        Sliced querysets cannot be filtered, so their primary keys are read
+        and compared with the current ones like other iterables.
+        """
         self._check_pk()
-        if self._set_object_class_supported:
+
+        if isinstance(objs, QuerySet) and \
+                objs.model is not self._object_class:
+            raise TypeError("Only objects of type '{0}' can be added to the "
+                            "set".format(self._object_class.__name__))
+
+        members = self._set_objects(**self._member_kwargs())\
+            .values_list('{0}__pk'.format(self._through_object_rel),
+                         flat=True)
+
+        # The difference is computed before any changes are made since
+        # the new objects may be derived from the current ones, e.g. when
+        # applying an inplace operator.
+        if isinstance(objs, QuerySet) and objs.query.can_filter():
+            lookup = '{0}__in'.format(self._through_object_rel)
+            removes = list(members.exclude(**{lookup: objs.values('pk')}))
+            adds = list(objs.exclude(pk__in=members)
+                        .values_list('pk', flat=True))
+        else:
+            if isinstance(objs, QuerySet):
+                pks = set(objs.values_list('pk', flat=True))
+            else:
+                pks = set(self._iter_pks(objs))
+            current = set(members)
+            removes = list(current - pks)
+            adds = list(pks - current)
+
+        # On a real delete, previously removed objects are deleted as well
+        if delete and self._set_object_class_supported:
             self._set_objects(removed=True).delete()
 
+        removed = self._remove_many(removes, delete=delete)
+        count = self._add_many(adds, added)
+
+        if removed or count:
+            self._update_count(count - removed)
+
+        return self.count
+
+    def _purge(self, batch_size=BATCH_SIZE, deadline=None):
+        """Deletes the set objects marked as `removed` in batches of
+        `batch_size`. Each batch is a separate delete so progress is kept if
+        interrupted. Stops after the batch during which `deadline`, a
+        `time.time()` value, passed. Returns the number of set objects
+        deleted and whether all were.
+        """
+        queryset = self._set_objects(removed=True).order_by()
+        deleted = 0
+
+        while True:
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+
+            if not pks:
+                return deleted, True
+
+            self._set_object_class.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+
+            # A partial batch was the last one
+            if deadline is not None and time.time() >= deadline:
+                return deleted, len(pks) < batch_size
+
+    def purge(self, batch_size=BATCH_SIZE):
+        """Deletes objects in the set marked as `removed` in batches of
+        `batch_size`. Returns the number of objects deleted.
+        """
+        self._check_pk()
+        if not self._set_object_class_supported:
+            return 0
+        return self._purge(batch_size)[0]
+
+    @classmethod
+    def compaction_candidates(cls, after=None):
+        """Returns the primary keys, in order, of the sets of this class due
+        for compaction according to `compaction_ratio` and `compaction_age`.
+        If `after` is given, only sets with a greater primary key are
+        returned. The set objects are counted with one aggregate query per
+        `removed` state.
+        """
+        if not cls._set_object_class_supported:
+            return []
+
+        objects = cls._set_object_class.objects.order_by()
+        rel = cls._through_set_rel
+
+        removed = dict(objects.filter(removed=True).values_list(rel)
+                       .annotate(Count('pk')))
+
+        if not removed:
+            return []
+
+        live = dict(objects.filter(removed=False).values_list(rel)
+                    .annotate(Count('pk')))
+
+        sets = cls._default_manager.order_by('pk')
+
+        if after is not None:
+            sets = sets.filter(pk__gt=after)
+
+        if cls.compaction_age is not None:
+            sets = sets.filter(modified__lte=datetime.now() -
+                               cls.compaction_age)
+
+        candidates = []
+
+        for pk in sets.values_list('pk', flat=True).iterator():
+            if pk not in removed:
+                continue
+
+            ratio = removed[pk] / float(removed[pk] + live.get(pk, 0))
+
+            if ratio >= cls.compaction_ratio:
+                candidates.append(pk)
+
+        return candidates
+
+    @classmethod
+    def compact(cls, batch_size=BATCH_SIZE, time_limit=None, after=None):
+        """Deletes the set objects marked as `removed` of the sets due for
+        compaction, see `compaction_candidates`, in batches of `batch_size`.
+
+        If `time_limit` is given in seconds, compaction stops once it is
+        exceeded, after at least one batch, and can be resumed by passing the
+        returned primary key as `after`. A set which was partially compacted
+        is compacted again when resuming.
+
+        Returns the number of set objects deleted and the primary key to
+        resume after, which is the last set fully compacted, `after` or 0 if
+        the first set was partially compacted, or None if all sets were.
+        """
+        deadline = None
+
+        if time_limit is not None:
+            deadline = time.time() + time_limit
+
+        deleted = 0
+        last = after
+
+        for pk in cls.compaction_candidates(after=after):
+            count, done = cls(pk=pk)._purge(batch_size, deadline)
+            deleted += count
+
+            if not done:
+                return deleted, 0 if last is None else last
+
+            last = pk
+
+            if deadline is not None and time.time() >= deadline:
+                return deleted, pk
+
+        return deleted, None
+
+    def recount(self, dry_run=False):
+        """Recomputes the count of this set from the set objects, e.g. after
+        the stored count drifted, and returns it. The stored count is
+        corrected unless `dry_run` is true.
+        """
+        self._check_pk()
+        count = self._set_objects(**self._member_kwargs()).count()
+
+        if count != self.count and not dry_run:
+            self.__class__._default_manager.filter(pk=self.pk)\
+                .update(count=count)
+            self.count = count
+
+        return count
+
+    @classmethod
+    @transaction.commit_on_success
+    def recount_all(cls, dry_run=False, batch_size=BATCH_SIZE):
+        """Recomputes the counts of all sets of this class with a single
+        aggregate query over the set objects. Returns a dict of the sets
+        whose stored count drifted, mapping their primary key to a tuple of
+        the stored and actual count.
+
+        The stored counts are corrected with one update per distinct count
+        and batch of `batch_size` sets unless `dry_run` is true.
+        """
+        counts = dict(cls._set_object_class.objects
+                      .filter(**cls._member_kwargs())
+                      .order_by().values_list(cls._through_set_rel)
+                      .annotate(Count('pk')))
+
+        drift = {}
+
+        for pk, stored in cls._default_manager.order_by()\
+                .values_list('pk', 'count').iterator():
+            actual = counts.get(pk, 0)
+            if actual != stored:
+                drift[pk] = (stored, actual)
+
+        if dry_run:
+            return drift
+
+        corrections = {}
+        for pk, (stored, actual) in drift.items():
+            corrections.setdefault(actual, []).append(pk)
+
+        for count, pks in corrections.items():
+            for chunk in _chunked(pks, batch_size):
+                cls._default_manager.filter(pk__in=chunk).update(count=count)
+
+        return drift
+
 
 class SetObject(models.Model):
     """Adds additional information about the objects that have been `added`
@@ -499,9 +2158,78 @@ class SetObject(models.Model):
     class BookSetObject(ObjectSet):
         bookset = models.ForeignKey(BookSet)
         book = models.ForeignKey(Book)
+
+    The queries of sets filter set objects by the set and `removed` columns.
+    A composite index of the set, `removed` and object columns, and a partial
+    index of the objects not removed where supported, are defined in
+    `objectset.indexes` and created with the `objectset_indexes` command.
     """
     added = models.BooleanField(default=False)
     removed = models.BooleanField(default=False)
 
     class Meta(object):
         abstract = True
+
+
+class SignatureBand(models.Model):
+    """A band of the MinHash signature of a set used by `similar_to` to find
+    the sets sharing a band with a signature. The bands of all set classes
+    defining `minhash_field` are stored by the label of the class and the
+    primary key of the set, and looked up by the indexed hash of the values
+    of the band. They are replaced whenever the signature is written.
+    """
+    set_model = models.CharField(max_length=100)
+    set_pk = models.PositiveIntegerField()
+    band = models.PositiveSmallIntegerField()
+    hash = models.BigIntegerField(db_index=True)
+
+    class Meta(object):
+        unique_together = ('set_model', 'set_pk', 'band')
+
+
+def _delete_bands(sender, instance, **kwargs):
+    "Deletes the signature bands of deleted sets."
+    SignatureBand.objects.filter(set_model=instance._band_label(),
+                                 set_pk=instance.pk).delete()
+
+
+def _connect_bands(sender, **kwargs):
+    """Connects `_delete_bands` to the set classes defining `minhash_field`.
+    Receivers are only connected to these classes since they prevent the
+    fast deletion of other objects.
+    """
+    if issubclass(sender, ObjectSet) and sender.minhash_field \
+            and not sender._meta.abstract:
+        models.signals.post_delete.connect(_delete_bands, sender=sender)
+
+
+models.signals.class_prepared.connect(_prepare_relations)
+models.signals.class_prepared.connect(_connect_bands)
+
+
+def _create_indexes(sender, created_models, db=None, **kwargs):
+    """Creates the indexes of the set object tables of the created set
+    classes if the `OBJECTSET_CREATE_INDEXES` setting is true. Backends whose
+    indexes cannot be listed are skipped with a warning rather than failing
+    `syncdb`.
+    """
+    if not getattr(settings, 'OBJECTSET_CREATE_INDEXES', False):
+        return
+
+    for model in created_models:
+        if not issubclass(model, ObjectSet) or model._meta.proxy:
+            continue
+
+        using = db or router.db_for_write(model._set_object_class)
+        vendor = connections[using].vendor
+
+        if vendor not in LISTED_VENDORS:
+            warnings.warn('Indexes of set objects are not created for the '
+                          '{0} backend, create them manually for {1}'
+                          .format(vendor, model.__name__))
+            continue
+
+        create_missing_indexes(model, using=using)
+
+
+models.signals.post_syncdb.connect(_create_indexes)
@@ -0,0 +1,141 @@
+import zlib
+from array import array
+from bisect import bisect_left
+
+
+class PKSet(object):
+    """Immutable set of integer primary keys stored as a sorted array.
+
+    This is a compact in-memory representation of the members of a set
+    which supports set operations and membership tests without querying
+    the database. Use `ObjectSet.pkset()` to load one and
+    `ObjectSet.from_pks()` to create a set from one.
+
+    The operations merge the sorted arrays in linear time and return new
+    `PKSet` instances.
+    """
+    typecode = 'l'
+
+    def __init__(self, pks=()):
+        if isinstance(pks, PKSet):
+            self._array = pks._array
+        else:
+            self._array = array(self.typecode, sorted(set(pks)))
+
+    @classmethod
+    def _from_sorted(cls, values):
+        "Returns a new instance from sorted, unique values."
+        instance = cls.__new__(cls)
+        instance._array = array(cls.typecode, values)
+        return instance
+
+    def __len__(self):
+        return len(self._array)
+
+    def __iter__(self):
+        return iter(self._array)
+
+    def __contains__(self, pk):
+        a = self._array
+        i = bisect_left(a, pk)
+        return i != len(a) and a[i] == pk
+
+    def __eq__(self, other):
+        if not isinstance(other, PKSet):
+            return NotImplemented
+        return self._array == other._array
+
+    def __ne__(self, other):
+        if not isinstance(other, PKSet):
+            return NotImplemented
+        return self._array != other._array
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, list(self._array))
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __xor__(self, other):
+        return self.symmetric_difference(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def _merge(self, other, left, both, right):
+        """Merges the two sorted arrays. `left`, `both` and `right` are
+        booleans of whether to keep values only in this set, in both sets
+        and only in `other` respectively.
+        """
+        a, b = self._array, PKSet(other)._array
+        i, j = 0, 0
+        n, m = len(a), len(b)
+        values = []
+
+        while i < n and j < m:
+            x, y = a[i], b[j]
+
+            if x < y:
+                if left:
+                    values.append(x)
+                i += 1
+            elif x > y:
+                if right:
+                    values.append(y)
+                j += 1
+            else:
+                if both:
+                    values.append(x)
+                i += 1
+                j += 1
+
+        if left:
+            values.extend(a[i:])
+        if right:
+            values.extend(b[j:])
+
+        return self._from_sorted(values)
+
+    def union(self, other):
+        "Returns the primary keys in either set."
+        return self._merge(other, True, True, True)
+
+    def intersection(self, other):
+        "Returns the primary keys in both sets."
+        return self._merge(other, False, True, False)
+
+    def difference(self, other):
+        "Returns the primary keys in this set but not in `other`."
+        return self._merge(other, True, False, False)
+
+    def symmetric_difference(self, other):
+        "Returns the primary keys in exactly one of the sets."
+        return self._merge(other, True, False, True)
+
+    def dumps(self):
+        """Returns the primary keys serialized as a compressed string. The
+        differences between consecutive keys are stored, which compress well
+        for dense sets.
+        """
+        a = self._array
+        deltas = array(self.typecode, a[:1])
+        deltas.extend([a[i] - a[i - 1] for i in xrange(1, len(a))])
+        return zlib.compress(deltas.tostring())
+
+    @classmethod
+    def loads(cls, value):
+        "Returns a set from a string returned by `dumps`."
+        deltas = array(cls.typecode)
+        deltas.fromstring(zlib.decompress(value))
+
+        values = []
+        total = 0
+
+        for delta in deltas:
+            total += delta
+            values.append(total)
+
+        return cls._from_sorted(values)
@@ -171,8 +171,7 @@ class BaseSetResource(Resource):
 
     def get_serialize_template(self, request, **kwargs):
         "Prepare the serialize template"
-        instance = self.model()
-        relation = instance._set_object_rel
+        relation = self.model._set_object_rel
 
         object_template = self.get_serialize_object_template(request, **kwargs)
 
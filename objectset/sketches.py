@@ -0,0 +1,214 @@
+import math
+import random
+import zlib
+import base64
+import struct
+import hashlib
+
+
+def _hash(pk):
+    "Returns a 64-bit hash of a primary key."
+    return struct.unpack('>Q', hashlib.sha1(str(pk)).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """HyperLogLog sketch for estimating the number of distinct primary keys
+    added to it. With the default precision of 12, 4096 registers are used
+    with a standard error of about 1.6%.
+
+    Sketches with the same precision can be merged to estimate the size of
+    a union. Primary keys cannot be removed from a sketch, so it must be
+    rebuilt to reflect removals.
+    """
+    def __init__(self, precision=12, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('Precision must be between 4 and 16')
+
+        self.precision = precision
+        self.size = 1 << precision
+
+        if registers is None:
+            registers = bytearray(self.size)
+        elif len(registers) != self.size:
+            raise ValueError('Expected {0} registers'.format(self.size))
+
+        self.registers = registers
+
+    def add(self, pk):
+        "Adds a primary key to the sketch."
+        h = _hash(pk)
+        bits = 64 - self.precision
+        index = h >> bits
+        w = h & ((1 << bits) - 1)
+        # Position of the leftmost 1-bit in the remaining bits
+        rank = bits - (len(bin(w)) - 2 if w else 0) + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, pks):
+        "Adds multiple primary keys to the sketch."
+        for pk in pks:
+            self.add(pk)
+
+    def count(self):
+        "Returns the estimated number of distinct primary keys."
+        m = float(self.size)
+
+        if self.size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        elif self.size == 64:
+            alpha = 0.709
+        elif self.size == 32:
+            alpha = 0.697
+        else:
+            alpha = 0.673
+
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+
+        # Small range correction using linear counting
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(bytearray(1))
+            if zeros:
+                estimate = m * math.log(m / zeros)
+
+        return int(round(estimate))
+
+    def union(self, other):
+        "Returns a new sketch of the primary keys in either sketch."
+        if other.precision != self.precision:
+            raise ValueError('Sketches must have the same precision')
+
+        registers = bytearray([max(a, b) for a, b in
+                               zip(self.registers, other.registers)])
+
+        return self.__class__(self.precision, registers)
+
+    def dumps(self):
+        "Returns the sketch serialized as an ASCII string."
+        data = struct.pack('>B', self.precision) + \
+            zlib.compress(bytes(self.registers))
+        return base64.b64encode(data)
+
+    @classmethod
+    def loads(cls, value):
+        "Returns a sketch from a string returned by `dumps`."
+        data = base64.b64decode(value)
+        precision = struct.unpack('>B', data[:1])[0]
+        return cls(precision, bytearray(zlib.decompress(data[1:])))
+
+
+# Mersenne prime used for the universal hash functions of MinHash
+_MERSENNE_PRIME = (1 << 61) - 1
+
+_MAX_HASH = (1 << 32) - 1
+
+_permutations = {}
+
+
+def _get_permutations(num_perm):
+    "Returns the coefficients of `num_perm` hash functions."
+    if num_perm not in _permutations:
+        generator = random.Random(num_perm)
+        _permutations[num_perm] = [
+            (generator.randint(1, _MERSENNE_PRIME - 1),
+             generator.randint(0, _MERSENNE_PRIME - 1))
+            for _ in xrange(num_perm)
+        ]
+    return _permutations[num_perm]
+
+
+class MinHash(object):
+    """MinHash signature of the primary keys added to it for estimating the
+    Jaccard similarity of sets. The signature has `num_perm` values each
+    being the minimum of a hash function over the primary keys, the
+    fraction of equal values in two signatures estimates their similarity.
+
+    Like `HyperLogLog`, primary keys cannot be removed from a signature.
+    """
+    def __init__(self, num_perm=128, values=None):
+        self.num_perm = num_perm
+
+        if values is None:
+            values = [_MAX_HASH] * num_perm
+        elif len(values) != num_perm:
+            raise ValueError('Expected {0} values'.format(num_perm))
+
+        self.values = values
+
+    def add(self, pk):
+        "Adds a primary key to the signature."
+        h = _hash(pk)
+        values = self.values
+
+        for i, (a, b) in enumerate(_get_permutations(self.num_perm)):
+            value = ((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH
+            if value < values[i]:
+                values[i] = value
+
+    def update(self, pks):
+        "Adds multiple primary keys to the signature."
+        for pk in pks:
+            self.add(pk)
+
+    def is_empty(self):
+        "Returns true if no primary keys have been added."
+        return self.values == [_MAX_HASH] * self.num_perm
+
+    def jaccard(self, other):
+        "Returns the estimated Jaccard similarity with `other`."
+        if other.num_perm != self.num_perm:
+            raise ValueError('Signatures must have the same number of '
+                             'permutations')
+
+        if self.is_empty() or other.is_empty():
+            return 0.0
+
+        equal = sum([1 for a, b in zip(self.values, other.values) if a == b])
+        return equal / float(self.num_perm)
+
+    def union(self, other):
+        "Returns a new signature of the primary keys in either signature."
+        if other.num_perm != self.num_perm:
+            raise ValueError('Signatures must have the same number of '
+                             'permutations')
+
+        return self.__class__(self.num_perm, [min(a, b) for a, b in
+                                              zip(self.values, other.values)])
+
+    def dumps(self):
+        "Returns the signature serialized as an ASCII string."
+        return base64.b64encode(struct.pack('>H', self.num_perm) +
+                                struct.pack('>{0}I'.format(self.num_perm),
+                                            *self.values))
+
+    @classmethod
+    def loads(cls, value):
+        "Returns a signature from a string returned by `dumps`."
+        data = base64.b64decode(value)
+        num_perm = struct.unpack('>H', data[:2])[0]
+        values = struct.unpack('>{0}I'.format(num_perm), data[2:])
+        return cls(num_perm, list(values))
+
+
+def band_hashes(minhash, bands=32):
+    """Returns a list of the band number and a 63-bit hash of the values of
+    each band of the signature `minhash` for locality-sensitive hashing.
+    The signature is split into `bands` of equal size, two signatures are
+    candidates for being similar if all values of at least one band are
+    equal. The number of bands must divide the number of permutations.
+    """
+    if minhash.num_perm % bands:
+        raise ValueError('The number of bands must divide the number '
+                         'of permutations')
+
+    rows = minhash.num_perm // bands
+    hashes = []
+
+    for band in xrange(bands):
+        values = minhash.values[band * rows:(band + 1) * rows]
+        data = struct.pack('>H{0}I'.format(rows), band, *values)
+        h = struct.unpack('>Q', hashlib.sha1(data).digest()[:8])[0]
+        hashes.append((band, h >> 1))
+
+    return hashes
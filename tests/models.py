@@ -20,11 +20,51 @@ class RecordSetObject(SetObject):
         unique_together = ('object_set', 'set_object')
 
 
+class ProxyRecordSet(RecordSet):
+    class Meta(object):
+        proxy = True
+
+
+class ChildRecordSet(RecordSet):
+    label = models.CharField(max_length=50, blank=True)
+
+
 class SimpleRecordSet(ObjectSet):
     records = models.ManyToManyField(Record)
 
 
+class SketchedRecordSet(ObjectSet):
+    sketch = models.TextField(blank=True, editable=False)
+    signature = models.TextField(blank=True, editable=False)
+    records = models.ManyToManyField(Record)
+
+    hll_field = 'sketch'
+    minhash_field = 'signature'
+
+
 class ProtectedRecordSet(ObjectSet):
     user = models.ForeignKey(User, null=True, blank=True)
     session_key = models.CharField(max_length=40, null=True, blank=True)
     records = models.ManyToManyField(Record)
+
+
+class StampedRecordSet(ObjectSet):
+    records = models.ManyToManyField(Record, through='StampedRecordSetObject')
+
+
+class StampedRecordSetObject(SetObject):
+    object_set = models.ForeignKey(StampedRecordSet)
+    set_object = models.ForeignKey(Record)
+    stamped = models.DateTimeField(auto_now_add=True)
+
+    class Meta(object):
+        unique_together = ('object_set', 'set_object')
+
+
+class LooseRecordSet(ObjectSet):
+    records = models.ManyToManyField(Record, through='LooseRecordSetObject')
+
+
+class LooseRecordSetObject(SetObject):
+    object_set = models.ForeignKey(LooseRecordSet)
+    set_object = models.ForeignKey(Record)
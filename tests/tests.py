@@ -1,12 +1,34 @@
+import os
+import django
 import json
+import shutil
+import warnings
+import tempfile
+from datetime import datetime, timedelta
+from StringIO import StringIO
 from django.test import TestCase
-from django.db import IntegrityError
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.utils import unittest
+from django.db import IntegrityError, connection
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.query import QuerySet, EmptyQuerySet
 from django.contrib.auth.models import User
-from objectset.models import ObjectSetError
+from django.core.management import call_command
+from django.db.models.signals import post_save
+from objectset.models import ObjectSetError, get_set_relation, \
+    _relations, _pending_relations, _create_indexes, SignatureBand
 from objectset.forms import objectset_form_factory
+from objectset.pkset import PKSet
+from objectset.sketches import HyperLogLog, MinHash, band_hashes
+from objectset import expressions, indexes
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from .models import Record, RecordSet, RecordSetObject, SimpleRecordSet, \
-    ProtectedRecordSet
+    ProtectedRecordSet, SketchedRecordSet, StampedRecordSet, \
+    StampedRecordSetObject, ProxyRecordSet, ChildRecordSet, LooseRecordSet
 
 
 class SetTestCase(TestCase):
@@ -21,6 +43,41 @@ class SetTestCase(TestCase):
         self.assertEqual(s._through_set_rel, 'simplerecordset')
         self.assertEqual(s._through_object_rel, 'record')
 
+    def test_relation(self):
+        # Resolved when the models were prepared, including the lazily
+        # referenced through model of RecordSet
+        self.assertEqual(_pending_relations, [])
+
+        relation = _relations[RecordSet]
+        self.assertTrue(get_set_relation(RecordSet) is relation)
+        self.assertEqual(relation.set_object_class, RecordSetObject)
+        self.assertEqual(relation.through_set_rel, 'object_set')
+        self.assertEqual(relation.through_object_rel, 'set_object')
+        self.assertTrue(relation.set_object_class_supported)
+
+        self.assertEqual(RecordSet._object_class, Record)
+        self.assertRaises(AttributeError, setattr, relation,
+                          'object_class', User)
+
+    def test_relation_inherited(self):
+        # Proxies and multi-table children use the foreign key to the parent
+        for model in (ProxyRecordSet, ChildRecordSet):
+            relation = get_set_relation(model)
+            self.assertEqual(relation.set_object_class, RecordSetObject)
+            self.assertEqual(relation.through_set_rel, 'object_set')
+            self.assertEqual(relation.through_object_rel, 'set_object')
+
+        s = ProxyRecordSet([1, 2, 3], save=True)
+        s.remove(Record(pk=3))
+        self.assertEqual(s.count, 2)
+        self.assertEqual(sorted(o.pk for o in s), [1, 2])
+        self.assertEqual(sorted(RecordSet.objects.get(pk=s.pk).pks()), [1, 2])
+
+        s = ChildRecordSet([1, 2, 3], label='child', save=True)
+        s.add(Record(pk=4))
+        self.assertEqual(s.count, 4)
+        self.assertEqual(sorted(o.pk for o in s), [1, 2, 3, 4])
+
     def test_init(self):
         objs = [Record(pk=i) for i in xrange(1, 5)]
         s = SimpleRecordSet(objs)
@@ -48,6 +105,21 @@ class SetTestCase(TestCase):
         self.assertEqual(s.count, 4)
         self.assertEqual(s.pk, 1)
 
+    def test_init_loaded(self):
+        SimpleRecordSet([Record(pk=i) for i in xrange(1, 5)], save=True)
+        SimpleRecordSet(save=True)
+
+        # Loaded sets do not create a pending queryset
+        with self.assertNumQueries(1):
+            sets = list(SimpleRecordSet.objects.all())
+
+        for s in sets:
+            self.assertEqual(s._pending_objects, None)
+
+        self.assertEqual(len(sets[0]), 4)
+        self.assertEqual(sorted(sets[0].pks()), [1, 2, 3, 4])
+        self.assertTrue(isinstance(sets[1]._pending, EmptyQuerySet))
+
     def teset_init_object_ids(self):
         objs = range(1, 5)
         s = SimpleRecordSet(objects=objs)
@@ -138,6 +210,129 @@ class SetTestCase(TestCase):
         s4.save()
         self.assertEqual(sorted([o.pk for o in s4]), [3, 4])
 
+    def test_save_pending(self):
+        s1 = SimpleRecordSet([Record(pk=i) for i in xrange(1, 5)], save=True)
+        s2 = SimpleRecordSet([Record(pk=i) for i in xrange(3, 7)], save=True)
+        s3 = s1 | s2
+
+        # Insert of the set, a single insert of the set objects and the
+        # update of the count
+        with self.assertNumQueries(3):
+            s3.save()
+
+        self.assertEqual(s3.count, 6)
+        self.assertEqual(s3._set_objects().count(), 6)
+        self.assertEqual(sorted([o.pk for o in s3]), range(1, 7))
+
+        s4 = s1 & SimpleRecordSet([Record(pk=i) for i in xrange(7, 9)])
+        s4.save()
+        self.assertEqual(s4.count, 0)
+
+    def test_save_pending_sliced(self):
+        for i in xrange(1, 11):
+            Record(pk=i).save()
+
+        # The ordering of the sliced queryset is kept
+        s = SimpleRecordSet(Record.objects.order_by('-pk')[:2], save=True)
+        self.assertEqual(s.count, 2)
+        self.assertEqual(sorted([o.pk for o in s]), [9, 10])
+
+    def test_save_pending_type(self):
+        self.assertRaises(TypeError, SimpleRecordSet, User.objects.all(),
+                          save=True)
+
+    def test_save_pending_auto_now(self):
+        s1 = StampedRecordSet([1, 2, 3], save=True)
+        s2 = StampedRecordSet([3, 4], save=True)
+        s3 = s1 | s2
+        s3.save()
+
+        self.assertEqual(s3.count, 4)
+        stamps = StampedRecordSetObject.objects.filter(object_set=s3)\
+            .values_list('stamped', flat=True)
+        self.assertEqual(len(stamps), 4)
+        self.assertFalse(None in stamps)
+
+    def test_concurrent_counts(self):
+        s = ProtectedRecordSet(save=True)
+        s1 = ProtectedRecordSet.objects.get(pk=s.pk)
+        s2 = ProtectedRecordSet.objects.get(pk=s.pk)
+
+        s2.session_key = 'abc'
+        s2.save()
+
+        # Both instances change the count relative to the stored one and
+        # other columns are not overwritten
+        s1.update([Record(pk=i) for i in xrange(1, 4)])
+        s2.add(Record(pk=4))
+        s1.remove(Record(pk=1))
+
+        s = ProtectedRecordSet.objects.get(pk=s.pk)
+        self.assertEqual(s.count, 3)
+        self.assertEqual(s.session_key, 'abc')
+
+    @unittest.skipIf(django.VERSION < (1, 5), 'Requires update_fields')
+    def test_count_signals(self):
+        s = SimpleRecordSet(save=True)
+        saved = []
+
+        def receiver(sender, instance, update_fields, **kwargs):
+            saved.append((instance.count, sorted(update_fields)))
+
+        post_save.connect(receiver, sender=SimpleRecordSet)
+
+        try:
+            s.add(Record(pk=1))
+            s.update([Record(pk=2), Record(pk=3)])
+            s.remove(Record(pk=1))
+        finally:
+            post_save.disconnect(receiver, sender=SimpleRecordSet)
+
+        self.assertEqual(len(saved), 3)
+        self.assertEqual(saved[0][1], ['count', 'modified'])
+        self.assertEqual(s.count, 2)
+        self.assertEqual(SimpleRecordSet.objects.get(pk=s.pk).count, 2)
+
+        # Pending objects are not saved along with the count
+        s |= SimpleRecordSet([4])
+        s.add(Record(pk=5))
+        self.assertEqual(sorted(SimpleRecordSet.objects.get(pk=s.pk).pks()),
+                         [2, 3, 5])
+
+    def test_objects_join(self):
+        s = SimpleRecordSet(save=True)
+        s.bulk([5, 2, 7, 1])
+
+        sql = str(s.objects.query)
+        self.assertTrue('INNER JOIN' in sql)
+        self.assertFalse(' IN (' in sql)
+        self.assertEqual(sorted(o.pk for o in s), [1, 2, 5, 7])
+
+        s.insertion_order = True
+        self.assertEqual([o.pk for o in s], [5, 2, 7, 1])
+
+        # Pending objects are still included
+        s |= SimpleRecordSet([Record(pk=3)])
+        self.assertEqual(sorted(o.pk for o in s), [1, 2, 3, 5, 7])
+
+    def test_pending_len(self):
+        s1 = SimpleRecordSet([Record(pk=i) for i in xrange(1, 5)], save=True)
+        s2 = SimpleRecordSet([Record(pk=i) for i in xrange(3, 7)], save=True)
+        s3 = s1 & s2
+
+        # Counted once until the pending objects change
+        with self.assertNumQueries(1):
+            self.assertEqual(len(s3), 2)
+            self.assertEqual(len(s3), 2)
+
+        s3 |= s1
+        self.assertEqual(len(s3), 4)
+        self.assertEqual(len(SimpleRecordSet()), 0)
+
+        # Saved sets use the stored count
+        with self.assertNumQueries(0):
+            self.assertEqual(len(s1), 4)
+
     def test_empty_set(self):
         s = SimpleRecordSet()
         s.save()
@@ -194,6 +389,41 @@ class SetTestCase(TestCase):
         # But not again..
         self.assertRaises(IntegrityError, s.bulk, [objs[3]])
 
+    def test_bulk_batches(self):
+        s = SimpleRecordSet()
+        s.save()
+
+        progress = []
+
+        # Generator of primary keys
+        pks = (i for i in xrange(1, 11))
+
+        with self.assertNumQueries(5):
+            self.assertEqual(s.bulk(pks, batch_size=3,
+                                    progress=progress.append), 10)
+
+        self.assertEqual(progress, [3, 6, 9, 10])
+        self.assertEqual(s.count, 10)
+        self.assertEqual(sorted(o.pk for o in s), range(1, 11))
+
+        # Exceeds the SQLite variable limit in a single statement
+        s2 = SimpleRecordSet()
+        s2.save()
+        self.assertEqual(s2.bulk(xrange(1, 2001)), 2000)
+        self.assertEqual(s2._set_objects().count(), 2000)
+
+    def test_bulk_ignore_conflicts(self):
+        s = SimpleRecordSet()
+        s.save()
+
+        self.assertEqual(s.bulk([1, 2, 2, 3], ignore_conflicts=True), 3)
+        self.assertEqual(s.count, 3)
+
+        # Retrying the same batch is safe
+        self.assertEqual(s.bulk([1, 2, 3, 4], ignore_conflicts=True), 1)
+        self.assertEqual(s.count, 4)
+        self.assertEqual(s._set_objects().count(), 4)
+
     def test_remove(self):
         s = SimpleRecordSet()
         s.save()
@@ -206,6 +436,47 @@ class SetTestCase(TestCase):
 
         self.assertEqual(s._set_objects().count(), 0)
 
+    def test_remove_many(self):
+        s = SimpleRecordSet()
+        s.save()
+        s.bulk([Record(pk=i) for i in xrange(1, 11)])
+
+        # Objects and primary keys can be mixed
+        self.assertEqual(s.remove_many([Record(pk=1), 2, 3, 20]), 3)
+        self.assertEqual(s.count, 7)
+
+        # Querysets are removed with a single delete
+        queryset = Record.objects.filter(pk__lte=5)
+
+        with self.assertNumQueries(3):
+            self.assertEqual(s.remove_many(queryset), 2)
+        self.assertEqual(s.count, 5)
+
+        other = SimpleRecordSet([8, 9, 10], save=True)
+        self.assertEqual(s.difference_update(other), 3)
+        self.assertEqual(s.count, 2)
+        self.assertEqual(sorted(o.pk for o in s), [6, 7])
+        self.assertEqual(s._set_objects().count(), 2)
+
+        self.assertRaises(TypeError, s.remove_many, RecordSet.objects.all())
+
+        # Sliced querysets keep their ordering
+        self.assertEqual(s.remove_many(Record.objects.order_by('-pk')[3:4]),
+                         1)
+        self.assertEqual(sorted(o.pk for o in s), [6])
+
+        # The objects of the set itself are selected from a derived table
+        # on MySQL, which is also valid on other backends
+        vendor = connection.vendor
+        connection.vendor = 'mysql'
+
+        try:
+            self.assertEqual(s.remove_many(s), 1)
+        finally:
+            connection.vendor = vendor
+
+        self.assertEqual(s._set_objects().count(), 0)
+
     def test_update(self):
         s = SimpleRecordSet()
         s.save()
@@ -222,6 +493,24 @@ class SetTestCase(TestCase):
         self.assertEqual(s.update([Record(pk=i) for i in xrange(10)]), 5)
         self.assertEqual(s.count, 10)
 
+    def test_update_queries(self):
+        s = SimpleRecordSet()
+        s.save()
+
+        s.update([Record(pk=i) for i in xrange(1, 4)])
+
+        # One query to find existing objects, one bulk insert and the
+        # update of the set itself regardless of the number of objects
+        with self.assertNumQueries(3):
+            self.assertEqual(s.update([Record(pk=i) for i in xrange(1, 11)]),
+                             7)
+        self.assertEqual(s.count, 10)
+
+        # Duplicates are only added once
+        s.clear()
+        self.assertEqual(s.update([Record(pk=1), Record(pk=1)]), 1)
+        self.assertEqual(s.count, 1)
+
     def test_replace(self):
         s = SimpleRecordSet()
         s.save()
@@ -231,6 +520,16 @@ class SetTestCase(TestCase):
 
         self.assertEqual(s._set_objects().count(), 4)
 
+    def test_replace_sliced(self):
+        for i in xrange(1, 11):
+            Record(pk=i).save()
+
+        s = SimpleRecordSet([1, 2, 9], save=True)
+        self.assertEqual(s.replace(Record.objects.order_by('-pk')[:2]), 2)
+        self.assertEqual(sorted([o.pk for o in s]), [9, 10])
+
+        self.assertRaises(TypeError, s.replace, User.objects.all())
+
     def test_clear(self):
         s = SimpleRecordSet()
         s.save()
@@ -256,6 +555,42 @@ class SetTestCase(TestCase):
         self.assertTrue(objs[0] in s)
         self.assertTrue(objs[7] in s)
         self.assertFalse(Record(pk=12) in s)
+        self.assertTrue(1 in s)
+        self.assertFalse(12 in s)
+
+    def test_contains_many(self):
+        s = SimpleRecordSet()
+        s.save()
+        s.bulk(xrange(1, 6))
+
+        with self.assertNumQueries(1):
+            contained = s.contains_many([Record(pk=1), 5, 6])
+        self.assertEqual(contained, {1: True, 5: True, 6: False})
+
+    def test_membership_cache(self):
+        s = SimpleRecordSet()
+        s.cache_membership = True
+        s.save()
+        s.bulk(xrange(1, 6))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(s.contains_many(xrange(1, 8)), {
+                1: True, 2: True, 3: True, 4: True, 5: True, 6: False,
+                7: False,
+            })
+            self.assertTrue(Record(pk=1) in s)
+            self.assertFalse(Record(pk=6) in s)
+            self.assertTrue(5 in s)
+            self.assertFalse(7 in s)
+
+        # Changes invalidate the cache
+        s.add(Record(pk=6))
+        s.remove(Record(pk=1))
+        self.assertTrue(Record(pk=6) in s)
+        self.assertFalse(Record(pk=1) in s)
+
+        s.clear()
+        self.assertFalse(Record(pk=6) in s)
 
 
 class SetObjectSetTestCase(TestCase):
@@ -270,6 +605,18 @@ class SetObjectSetTestCase(TestCase):
         self.assertEqual(s._through_set_rel, 'object_set')
         self.assertEqual(s._through_object_rel, 'set_object')
 
+    def test_save_pending(self):
+        s1 = RecordSet([Record(pk=i) for i in xrange(1, 5)], save=True)
+        s1.remove(Record(pk=1))
+        s2 = RecordSet([Record(pk=i) for i in xrange(3, 7)], save=True)
+        s3 = s1 | s2
+        s3.save()
+
+        self.assertEqual(s3.count, 5)
+        self.assertEqual(sorted([o.pk for o in s3]), range(2, 7))
+        self.assertEqual(s3.added.objects.count(), 0)
+        self.assertEqual(s3.removed.objects.count(), 0)
+
     def test_add(self):
         s = RecordSet([Record(pk=1)])
         s.save()
@@ -293,6 +640,126 @@ class SetObjectSetTestCase(TestCase):
         # The `removed` record still exists
         self.assertEqual(s.removed.objects.count(), 1)
 
+    def test_remove_many(self):
+        s = RecordSet()
+        s.save()
+        s.bulk([Record(pk=i) for i in xrange(1, 11)])
+
+        with self.assertNumQueries(2):
+            self.assertEqual(s.remove_many(range(1, 6)), 5)
+        self.assertEqual(s.count, 5)
+
+        # Already removed objects are not counted again
+        self.assertEqual(s.remove_many(Record.objects.filter(pk__lte=6)), 1)
+        self.assertEqual(s.count, 4)
+
+        # The `removed` records still exist
+        self.assertEqual(s.removed.objects.count(), 6)
+        self.assertEqual(s._set_objects().count(), 10)
+
+        # Deleting also deletes the removed records
+        self.assertEqual(s.remove_many(range(1, 8), delete=True), 1)
+        self.assertEqual(s.count, 3)
+        self.assertEqual(s._set_objects().count(), 3)
+
+    def test_contains_removed(self):
+        s = RecordSet([Record(pk=1), Record(pk=2)], save=True)
+        s.remove(Record(pk=1))
+
+        self.assertFalse(Record(pk=1) in s)
+        self.assertTrue(Record(pk=2) in s)
+        self.assertEqual(s.contains_many([1, 2]), {1: False, 2: True})
+
+    def test_batch(self):
+        s = RecordSet([Record(pk=i) for i in xrange(1, 4)], save=True)
+        s.remove(Record(pk=3))
+
+        # One query to look up the membership, one to remove, three to
+        # restore and insert and the update of the set on exit
+        with self.assertNumQueries(6):
+            with s.batch() as batch:
+                batch.add(Record(pk=4))
+                batch.remove(Record(pk=4))
+                batch.remove(Record(pk=5))
+                batch.update([Record(pk=3), Record(pk=6), Record(pk=1)])
+                batch.remove_many([Record(pk=2)])
+                self.assertEqual(len(batch), 6)
+                self.assertRaises(TypeError, batch.add, User(pk=1))
+                # Nothing is flushed within the block
+                self.assertEqual(s.count, 2)
+
+        self.assertEqual(batch.added, set([3, 6]))
+        self.assertEqual(batch.removed, set([2]))
+        self.assertEqual(s.count, 3)
+        self.assertEqual(RecordSet.objects.get(pk=s.pk).count, 3)
+        self.assertEqual(sorted(s.pks()), [1, 3, 6])
+        self.assertEqual(s.removed.objects.count(), 1)
+
+        # Changes are discarded on errors
+        try:
+            with s.batch() as batch:
+                batch.add(Record(pk=7))
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertEqual(sorted(s.pks()), [1, 3, 6])
+        self.assertEqual(batch.flush(), (0, 0))
+
+    def test_objects_join(self):
+        s = RecordSet(save=True)
+        s.bulk([9, 3, 5, 1])
+        s.remove(Record(pk=3))
+
+        sql = str(s.objects.query)
+        self.assertTrue('INNER JOIN' in sql)
+        self.assertFalse(' IN (' in sql)
+        self.assertEqual(sorted(o.pk for o in s), [1, 5, 9])
+
+        s.insertion_order = True
+        self.assertEqual([o.pk for o in s], [9, 5, 1])
+
+    def test_objects_not_unique(self):
+        s = LooseRecordSet(save=True)
+        s.bulk([1, 2])
+        s.bulk([2])
+
+        # Without a unique set and object the join would repeat objects
+        self.assertFalse(LooseRecordSet._unique_set_objects())
+        self.assertTrue(RecordSet._unique_set_objects())
+        self.assertEqual(sorted(o.pk for o in s), [1, 2])
+
+    def test_recount(self):
+        s1 = RecordSet([Record(pk=i) for i in xrange(1, 5)], save=True)
+        s1.remove(Record(pk=1))
+        s2 = RecordSet([Record(pk=1)], save=True)
+        s3 = RecordSet(save=True)
+
+        # Simulate drift
+        RecordSet.objects.filter(pk=s1.pk).update(count=10)
+        RecordSet.objects.filter(pk=s3.pk).update(count=2)
+
+        s1 = RecordSet.objects.get(pk=s1.pk)
+        self.assertEqual(s1.recount(dry_run=True), 3)
+        self.assertEqual(s1.count, 10)
+
+        drift = {s1.pk: (10, 3), s3.pk: (2, 0)}
+
+        with self.assertNumQueries(2):
+            self.assertEqual(RecordSet.recount_all(dry_run=True), drift)
+
+        call_command('recount_objectsets', 'tests.RecordSet', verbosity=0)
+
+        self.assertEqual(RecordSet.recount_all(), {})
+        self.assertEqual(RecordSet.objects.get(pk=s1.pk).count, 3)
+        self.assertEqual(RecordSet.objects.get(pk=s2.pk).count, 1)
+        self.assertEqual(RecordSet.objects.get(pk=s3.pk).count, 0)
+
+        RecordSet.objects.filter(pk=s2.pk).update(count=0)
+        s2 = RecordSet.objects.get(pk=s2.pk)
+        self.assertEqual(s2.recount(), 1)
+        self.assertEqual(RecordSet.objects.get(pk=s2.pk).count, 1)
+
     def test_remove_delete(self):
         s = RecordSet()
         s.save()
@@ -306,6 +773,69 @@ class SetObjectSetTestCase(TestCase):
         # Real delete
         self.assertEqual(s._set_objects().count(), 0)
 
+    def test_update(self):
+        s = RecordSet()
+        s.save()
+
+        s.update([Record(pk=i) for i in xrange(1, 6)], added=False)
+        s.remove(Record(pk=2))
+        s.remove(Record(pk=3))
+        self.assertEqual(s.count, 3)
+
+        # Removed objects are restored rather than inserted again
+        self.assertEqual(s.update([Record(pk=i) for i in xrange(1, 8)]), 4)
+        self.assertEqual(s.count, 7)
+        self.assertEqual(s._set_objects().count(), 7)
+        self.assertEqual(sorted(o.pk for o in s.added), [2, 3, 6, 7])
+
+    def test_update_ignore_conflicts(self):
+        s = RecordSet()
+        s.save()
+
+        s.bulk([Record(pk=i) for i in xrange(1, 4)])
+        s.remove(Record(pk=1))
+
+        # One update to restore removed objects and one insert
+        with self.assertNumQueries(3):
+            self.assertEqual(s.update([Record(pk=i) for i in xrange(1, 6)],
+                                      ignore_conflicts=True), 3)
+
+        self.assertEqual(s.count, 5)
+        self.assertEqual(s._set_objects().count(), 5)
+        self.assertEqual(sorted(o.pk for o in s.added), [1, 4, 5])
+
+    def test_update_ignore_conflicts_auto_now(self):
+        s = StampedRecordSet()
+        s.save()
+
+        # Date fields set on save are set on the inserted set objects
+        self.assertEqual(s.update([Record(pk=i) for i in xrange(1, 4)],
+                                  ignore_conflicts=True), 3)
+        self.assertEqual(s.count, 3)
+
+        stamps = StampedRecordSetObject.objects\
+            .values_list('stamped', flat=True)
+        self.assertEqual(len(stamps), 3)
+        self.assertFalse(None in stamps)
+
+    def test_bulk_ignore_conflicts_batches(self):
+        s = StampedRecordSet(save=True)
+
+        # The 5 columns of 400 rows exceed the 999 parameters of SQLite, so
+        # the insert is split in 3 statements
+        with self.assertNumQueries(5):
+            self.assertEqual(s.bulk(xrange(1, 401), batch_size=400,
+                                    ignore_conflicts=True), 400)
+        self.assertEqual(s._set_objects().count(), 400)
+
+    def test_ignore_conflicts_not_unique(self):
+        s = LooseRecordSet(save=True)
+        self.assertRaises(ImproperlyConfigured, s.bulk, [1, 1, 2],
+                          ignore_conflicts=True)
+        self.assertRaises(ImproperlyConfigured, s.update, [Record(pk=1)],
+                          ignore_conflicts=True)
+        self.assertEqual(s._set_objects().count(), 0)
+
     def test_replace(self):
         s = RecordSet()
         s.save()
@@ -316,6 +846,34 @@ class SetObjectSetTestCase(TestCase):
         # The `removed` records still exist
         self.assertEqual(s._set_objects().count(), 6)
 
+    def test_replace_delta(self):
+        s = RecordSet()
+        s.save()
+
+        s.update([Record(pk=i) for i in xrange(1, 7)], added=False)
+        s.remove(Record(pk=6))
+        self.assertEqual(s.replace(Record.objects.filter(pk__gte=4)), 7)
+        self.assertEqual(s.count, 7)
+
+        # Unchanged objects keep their flags, the removed object is restored
+        self.assertEqual(sorted(o.pk for o in s.added), [6, 7, 8, 9, 10])
+        self.assertEqual(sorted(o.pk for o in s.removed), [1, 2, 3])
+        self.assertEqual(s._set_objects().count(), 10)
+
+        # Nothing to change
+        with self.assertNumQueries(2):
+            self.assertEqual(s.replace(Record.objects.filter(pk__gte=4)), 7)
+
+    def test_ixor_delta(self):
+        s1 = RecordSet([Record(pk=i) for i in xrange(1, 5)], save=True)
+        s2 = RecordSet([Record(pk=i) for i in xrange(3, 7)], save=True)
+        s2 ^= s1
+        s2.save()
+
+        self.assertEqual(s2.count, 4)
+        self.assertEqual(sorted([o.pk for o in s2]), [1, 2, 5, 6])
+        self.assertEqual(sorted([o.pk for o in s2.removed]), [3, 4])
+
     def test_replace_delete(self):
         s = RecordSet()
         s.save()
@@ -365,6 +923,636 @@ class SetObjectSetTestCase(TestCase):
         # The `removed` records have been deleted
         self.assertEqual(s._set_objects().count(), 4)
 
+    def test_sets_for_objects(self):
+        s1 = RecordSet([1, 2, 3], save=True)
+        s2 = RecordSet([2, 3], save=True)
+        s2.remove(Record(pk=3))
+        RecordSet([4], save=True)
+
+        self.assertEqual(
+            sorted(s.pk for s in RecordSet.objects.containing(Record(pk=2))),
+            [s1.pk, s2.pk])
+        self.assertEqual([s.pk for s in RecordSet.objects.containing(3)],
+                         [s1.pk])
+        self.assertRaises(TypeError, RecordSet.objects.containing,
+                          User(pk=1))
+
+        expected = {1: [s1.pk], 2: [s1.pk, s2.pk], 3: [s1.pk], 5: []}
+
+        with self.assertNumQueries(1):
+            self.assertEqual(RecordSet.sets_for_objects(
+                [Record(pk=1), 2, 3, 5]), expected)
+
+        memo = {}
+        RecordSet.sets_for_objects([1, 2], memo=memo)
+
+        # Only the object not in the memo is looked up
+        with self.assertNumQueries(1):
+            self.assertEqual(RecordSet.sets_for_objects([1, 2, 3, 5],
+                                                        memo=memo), expected)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(RecordSet.sets_for_objects([5, 1], memo=memo),
+                             {1: [s1.pk], 5: []})
+
+    def test_compact(self):
+        # 2 of 4, 1 of 4 and no removed objects
+        s1 = RecordSet([1, 2, 3, 4], save=True)
+        s1.remove_many([1, 2])
+        s2 = RecordSet([1, 2, 3, 4], save=True)
+        s2.remove(Record(pk=1))
+        s3 = RecordSet([1, 2], save=True)
+
+        self.assertEqual(RecordSet.compaction_candidates(), [s1.pk])
+        self.assertEqual(RecordSet.compaction_candidates(after=s1.pk), [])
+
+        RecordSet.compaction_ratio = 0.25
+        RecordSet.compaction_age = timedelta(days=1)
+
+        try:
+            self.assertEqual(RecordSet.compaction_candidates(), [])
+
+            RecordSet.objects.update(modified=datetime.now() -
+                                     timedelta(days=2))
+            self.assertEqual(RecordSet.compaction_candidates(),
+                             [s1.pk, s2.pk])
+
+            # Stops after the first batch, the partially compacted set is
+            # compacted again when resuming
+            self.assertEqual(RecordSet.compact(batch_size=1, time_limit=0),
+                             (1, 0))
+            self.assertEqual(s1._set_objects().count(), 3)
+
+            # Resumes after the set once it was fully compacted
+            self.assertEqual(RecordSet.compact(batch_size=2, time_limit=0,
+                                               after=0), (1, s1.pk))
+            self.assertEqual(s1._set_objects().count(), 2)
+            self.assertEqual(s2._set_objects().count(), 4)
+
+            call_command('compact_objectsets', 'tests.RecordSet',
+                         batch_size=1, after=str(s1.pk), verbosity=0)
+            self.assertEqual(s2._set_objects().count(), 3)
+            self.assertEqual(RecordSet.compaction_candidates(), [])
+        finally:
+            del RecordSet.compaction_ratio
+            del RecordSet.compaction_age
+
+        self.assertEqual(sorted(s1.pks()), [3, 4])
+        self.assertEqual(len(s3), 2)
+
+
+class ExpressionTestCase(TestCase):
+    def setUp(self):
+        self.a = SimpleRecordSet([1, 2, 3, 4], save=True)
+        self.b = SimpleRecordSet([3, 4, 5, 6], save=True)
+        self.c = RecordSet([2, 3, 5, 7, 8], save=True)
+        self.c.remove(Record(pk=8))
+        self.d = SimpleRecordSet([3], save=True)
+
+    def assertOperations(self):
+        a, b, c, d = self.a, self.b, self.c, self.d
+
+        self.assertEqual(sorted(o.pk for o in (a | b) & c - d), [2, 5])
+        self.assertEqual(sorted(o.pk for o in a ^ (b & c)), [1, 2, 4, 5])
+        self.assertEqual(sorted(o.pk for o in (a - b) | (c & d)), [1, 2, 3])
+        self.assertEqual(sorted(o.pk for o in c - a - b), [7])
+        self.assertEqual(sorted(o.pk for o in a & SimpleRecordSet([4, 9])),
+                         [4])
+
+        s = a | b
+        s &= c
+        s.save()
+        self.assertEqual(sorted(o.pk for o in s), [2, 3, 5])
+
+    def test_compound(self):
+        self.assertOperations()
+
+        sql = str(((self.a | self.b) & self.c)._pending.query)
+        self.assertTrue('UNION' in sql)
+        self.assertTrue('INTERSECT' in sql)
+
+    def test_predicate(self):
+        vendors = expressions.COMPOUND_VENDORS
+        expressions.COMPOUND_VENDORS = ()
+
+        try:
+            self.assertOperations()
+            sql = str(((self.a | self.b) & self.c)._pending.query)
+            self.assertTrue('EXISTS' in sql)
+            self.assertFalse('INTERSECT' in sql)
+        finally:
+            expressions.COMPOUND_VENDORS = vendors
+
+    def test_sliced_operand(self):
+        for i in xrange(1, 11):
+            Record(pk=i).save()
+
+        # The ordering of the sliced queryset determines its objects
+        s = SimpleRecordSet(Record.objects.order_by('-pk')[:2])
+        self.assertEqual(sorted(o.pk for o in s | self.a), [1, 2, 3, 4, 9, 10])
+        first = SimpleRecordSet(Record.objects.order_by('pk')[:2])
+        self.assertEqual(sorted(o.pk for o in self.a - first), [3, 4])
+
+        vendors = expressions.COMPOUND_VENDORS
+        expressions.COMPOUND_VENDORS = ()
+
+        try:
+            self.assertEqual(sorted(o.pk for o in s | self.a),
+                             [1, 2, 3, 4, 9, 10])
+        finally:
+            expressions.COMPOUND_VENDORS = vendors
+
+    def test_nary(self):
+        sets = [SimpleRecordSet(range(i, i + 4), save=True)
+                for i in xrange(1, 6)]
+
+        s = SimpleRecordSet.intersection_all(sets[:4])
+        self.assertEqual(sorted(o.pk for o in s), [4])
+
+        s = SimpleRecordSet.union_all([x.pk for x in sets])
+        s.save()
+        self.assertEqual(s.count, 8)
+        self.assertEqual(sorted(o.pk for o in s), range(1, 9))
+
+        s = SimpleRecordSet.at_least(sets, 3)
+        self.assertEqual(sorted(o.pk for o in s), [3, 4, 5, 6])
+
+        s = SimpleRecordSet.intersection_all(sets)
+        self.assertEqual(list(s), [])
+        self.assertTrue(isinstance(SimpleRecordSet.union_all([])._pending,
+                                   EmptyQuerySet))
+
+        # Combined with other operators
+        s = SimpleRecordSet.union_all(sets[:2]) - sets[0]
+        self.assertEqual(sorted(o.pk for o in s), [5])
+
+    def test_nary_removed(self):
+        self.c.remove(Record(pk=2))
+        c2 = RecordSet([2, 3], save=True)
+
+        s = RecordSet.intersection_all([self.c, c2])
+        self.assertEqual(sorted(o.pk for o in s), [3])
+
+        s = RecordSet.union_all([self.c, c2])
+        self.assertEqual(sorted(o.pk for o in s), [2, 3, 5, 7])
+
+    def test_nary_type(self):
+        # Sets of other classes are not taken as primary keys of this class
+        self.assertRaises(TypeError, SimpleRecordSet.union_all,
+                          [self.a, self.c])
+        self.assertRaises(TypeError, SimpleRecordSet.intersection_all,
+                          [self.c])
+        self.assertRaises(TypeError, SimpleRecordSet.at_least,
+                          [self.a, self.b, self.c], 2)
+        self.assertRaises(TypeError, SimpleRecordSet.overlap_matrix,
+                          [self.a, self.c])
+
+    def test_overlap(self):
+        with self.assertNumQueries(1):
+            stats = self.a.overlap(self.c)
+
+        self.assertEqual(stats, {
+            'size': 4,
+            'other_size': 4,
+            'intersection': 2,
+            'union': 6,
+            'jaccard': 2 / 6.0,
+            'containment': 0.5,
+            'other_containment': 0.5,
+        })
+
+        # Pending and empty sets
+        stats = (self.a - self.d).overlap(SimpleRecordSet([3, 4, 9]))
+        self.assertEqual(stats['intersection'], 1)
+        self.assertEqual(stats['union'], 5)
+
+        stats = self.a.overlap(SimpleRecordSet())
+        self.assertEqual(stats['other_size'], 0)
+        self.assertEqual(stats['other_containment'], 0.0)
+
+    def test_overlap_matrix(self):
+        e = SimpleRecordSet(save=True)
+        sets = [self.a, self.b, self.d.pk, e]
+
+        with self.assertNumQueries(1):
+            matrix = SimpleRecordSet.overlap_matrix(sets)
+
+        self.assertEqual(matrix, [
+            [4, 2, 1, 0],
+            [2, 4, 1, 0],
+            [1, 1, 1, 0],
+            [0, 0, 0, 0],
+        ])
+
+        self.c.remove(Record(pk=2))
+        c2 = RecordSet([1, 2, 3], save=True)
+        self.assertEqual(RecordSet.overlap_matrix([self.c, c2]),
+                         [[3, 1], [1, 3]])
+
+    def test_simplify(self):
+        a, b = self.a, self.b
+        empty = SimpleRecordSet()
+
+        self.assertEqual((a & a)._compiled[0], expressions.SetLeaf(a))
+        self.assertEqual((a | empty)._compiled[0], expressions.SetLeaf(a))
+        self.assertEqual((empty - a)._compiled[0], expressions.EMPTY)
+        self.assertEqual(((a | b) ^ (a | b))._compiled[0], expressions.EMPTY)
+        self.assertTrue(isinstance((a & empty)._pending, EmptyQuerySet))
+
+    def test_invalid_operand(self):
+        s = ProtectedRecordSet([1], save=True)
+        self.assertEqual(sorted(o.pk for o in self.a & s), [1])
+
+        class Other(object):
+            _object_class = User
+
+        self.assertRaises(TypeError, lambda: self.a & Other())
+
+
+class MembersCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        RecordSet.cache_members = True
+
+    def tearDown(self):
+        del RecordSet.cache_members
+
+    def test_cached(self):
+        s = RecordSet([1, 2, 3], save=True)
+        s.remove(Record(pk=3))
+
+        # Loaded and stored on first use
+        with self.assertNumQueries(1):
+            self.assertTrue(Record(pk=1) in s)
+            self.assertFalse(Record(pk=3) in s)
+            self.assertEqual(sorted(s.pks()), [1, 2])
+
+        # Other instances read the cache
+        s = RecordSet.objects.get(pk=s.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(s.pkset(), PKSet([1, 2]))
+            self.assertEqual(s.contains_many([2, 3]), {2: True, 3: False})
+
+        # Only the objects are read
+        with self.assertNumQueries(1):
+            self.assertEqual([o.pk for o in s], [1, 2])
+
+        # Changes invalidate the cache
+        s.add(Record(pk=4))
+        s = RecordSet.objects.get(pk=s.pk)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(s.pks()), [1, 2, 4])
+            self.assertTrue(Record(pk=4) in s)
+
+    def test_invalidated_for_loaded_instances(self):
+        s = RecordSet([1, 2], save=True)
+
+        # Modified times are stored without microseconds by MySQL, so the
+        # time of the changing instance differs from the stored one and
+        # changes within the same second do not change the stored one
+        modified = s.modified.replace(microsecond=0)
+        RecordSet.objects.filter(pk=s.pk).update(modified=modified)
+
+        other = RecordSet.objects.get(pk=s.pk)
+        self.assertEqual(sorted(other.pks()), [1, 2])
+
+        s.add(Record(pk=3))
+        RecordSet.objects.filter(pk=s.pk).update(modified=modified)
+
+        other = RecordSet.objects.get(pk=s.pk)
+        self.assertEqual(sorted(other.pks()), [1, 2, 3])
+
+    def test_operators(self):
+        a = RecordSet([1, 2, 3], save=True)
+        b = RecordSet([2, 3, 4], save=True)
+        a.pkset()
+        b.pkset()
+
+        with self.assertNumQueries(0):
+            c = a & b
+            d = a ^ b
+
+        self.assertFalse(c._compiled)
+        self.assertEqual(sorted(o.pk for o in c), [2, 3])
+        self.assertEqual(sorted(o.pk for o in d), [1, 4])
+        self.assertEqual(len(a - a), 0)
+        self.assertEqual(sorted(o.pk for o in a | RecordSet([5])),
+                         [1, 2, 3, 5])
+
+    def test_save_pending(self):
+        a = RecordSet([1, 2], save=True)
+        b = RecordSet([2, 3], save=True)
+        a.pkset()
+
+        # The members are not read when saving a set without sketches
+        s = a | b
+        with self.assertNumQueries(3):
+            s.save()
+        self.assertEqual(sorted(s.pks()), [1, 2, 3])
+
+    def test_limits(self):
+        s = RecordSet([1, 2, 3], save=True)
+        s.members_cache_max_size = 2
+        s.pkset()
+        self.assertEqual(s._members, None)
+
+        s.members_cache_max_size = 10
+        s.members_cache_max_bytes = 1
+        self.assertEqual(s.pkset(), PKSet([1, 2, 3]))
+        self.assertEqual(cache.get(s._members_cache_key()), '')
+
+        # Not read again
+        with self.assertNumQueries(1):
+            self.assertTrue(Record(pk=1) in s)
+
+
+class PKSetTestCase(TestCase):
+    def test_operations(self):
+        a = PKSet([4, 1, 3, 2, 2])
+        b = PKSet(xrange(3, 7))
+
+        self.assertEqual(list(a), [1, 2, 3, 4])
+        self.assertEqual(len(a), 4)
+        self.assertTrue(3 in a)
+        self.assertFalse(5 in a)
+
+        self.assertEqual(list(a & b), [3, 4])
+        self.assertEqual(list(a | b), range(1, 7))
+        self.assertEqual(list(a ^ b), [1, 2, 5, 6])
+        self.assertEqual(list(a - b), [1, 2])
+        self.assertEqual(list(b - a), [5, 6])
+        self.assertEqual(a & PKSet(), PKSet())
+        self.assertEqual(a.union([10, 0]), PKSet([0, 1, 2, 3, 4, 10]))
+
+    def test_dumps(self):
+        a = PKSet([1, 2, 3, 1000, 2 ** 40])
+        self.assertEqual(PKSet.loads(a.dumps()), a)
+        self.assertEqual(PKSet.loads(PKSet().dumps()), PKSet())
+
+    def test_objectset(self):
+        s1 = RecordSet([Record(pk=i) for i in xrange(1, 5)], save=True)
+        s1.remove(Record(pk=1))
+        s2 = SimpleRecordSet([Record(pk=i) for i in xrange(3, 7)], save=True)
+
+        with self.assertNumQueries(1):
+            a = s1.pkset()
+        self.assertEqual(list(a), [2, 3, 4])
+
+        s3 = SimpleRecordSet.from_pks(a | s2.pkset())
+        self.assertEqual(s3.count, 5)
+        self.assertEqual(sorted(o.pk for o in s3), range(2, 7))
+
+        # Unsaved sets
+        self.assertEqual(list((s1 & s2).pkset()), [3, 4])
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class ArrayTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_to_array(self):
+        s = RecordSet()
+        s.save()
+        s.bulk([5, 3, 1, 2, 4])
+        s.remove(Record(pk=2))
+
+        # Two full chunks and an empty one
+        with self.assertNumQueries(3):
+            a = s.to_array(chunk_size=2)
+
+        self.assertEqual(a.dtype, numpy.int64)
+        self.assertEqual(a.tolist(), [1, 3, 4, 5])
+        self.assertEqual(RecordSet().to_array().tolist(), [])
+
+        s2 = SimpleRecordSet([4, 5, 6], save=True)
+        self.assertEqual((s & s2).to_array().tolist(), [4, 5])
+
+    def test_npy(self):
+        s1 = SimpleRecordSet([1, 2, 3, 4], save=True)
+        s2 = SimpleRecordSet([3, 4, 5, 6], save=True)
+
+        path1 = os.path.join(self.path, 's1.npy')
+        path2 = os.path.join(self.path, 's2.npy')
+        s1.dump_npy(path1)
+        s2.dump_npy(path2)
+
+        a1 = SimpleRecordSet.load_npy(path1)
+        a2 = SimpleRecordSet.load_npy(path2)
+        self.assertTrue(isinstance(a1, numpy.memmap))
+
+        s3 = SimpleRecordSet.from_array(numpy.setdiff1d(a1, a2))
+        self.assertEqual(s3.count, 2)
+        self.assertEqual(sorted(o.pk for o in s3), [1, 2])
+
+
+class SketchTestCase(TestCase):
+    def assertAlmostSize(self, estimate, size):
+        self.assertTrue(abs(estimate - size) <= size * 0.05,
+                        '{0} is not close to {1}'.format(estimate, size))
+
+    def test_hyperloglog(self):
+        a = HyperLogLog()
+        a.update(xrange(10000))
+        b = HyperLogLog()
+        b.update(xrange(5000, 20000))
+
+        self.assertAlmostSize(a.count(), 10000)
+        self.assertAlmostSize(a.union(b).count(), 20000)
+        self.assertEqual(HyperLogLog().count(), 0)
+
+        c = HyperLogLog.loads(a.dumps())
+        self.assertEqual(c.registers, a.registers)
+
+        self.assertRaises(ValueError, a.union, HyperLogLog(10))
+
+    def test_minhash(self):
+        a = MinHash()
+        a.update(xrange(1000))
+        b = MinHash()
+        b.update(xrange(500, 1500))
+
+        # Actual similarity is 1/3
+        self.assertTrue(abs(a.jaccard(b) - 1 / 3.0) < 0.15)
+        self.assertEqual(a.jaccard(a), 1.0)
+        self.assertEqual(a.jaccard(MinHash()), 0.0)
+        self.assertEqual(MinHash.loads(a.dumps()).values, a.values)
+
+        union = MinHash()
+        union.update(xrange(1500))
+        self.assertEqual(a.union(b).values, union.values)
+        self.assertRaises(ValueError, a.union, MinHash(64))
+
+        self.assertRaises(ValueError, band_hashes, a, bands=3)
+
+    def test_concurrent_sketches(self):
+        s = SketchedRecordSet(save=True)
+        s1 = SketchedRecordSet.objects.get(pk=s.pk)
+        s2 = SketchedRecordSet.objects.get(pk=s.pk)
+
+        # The additions of both instances are merged with the stored sketches
+        s1.update([Record(pk=i) for i in xrange(1, 51)])
+        s2.update([Record(pk=i) for i in xrange(51, 101)])
+        s1.remove(Record(pk=1))
+
+        s = SketchedRecordSet.objects.get(pk=s.pk)
+        self.assertAlmostSize(s.approx_count(), 100)
+
+        signature = MinHash()
+        signature.update(xrange(1, 101))
+        self.assertEqual(s._get_minhash().values, signature.values)
+
+        # Rebuilt sketches replace the stored ones
+        s.rebuild_sketches()
+        s = SketchedRecordSet.objects.get(pk=s.pk)
+        self.assertAlmostSize(s.approx_count(), 99)
+
+        # Only the sketches are written by a stale instance
+        stale = SketchedRecordSet.objects.get(pk=s.pk)
+        s.add(Record(pk=1))
+        stale.rebuild_sketches()
+        self.assertEqual(SketchedRecordSet.objects.get(pk=s.pk).count, 100)
+
+    def test_similar_to(self):
+        s1 = SketchedRecordSet(save=True)
+        s1.bulk(xrange(1, 101))
+        s2 = SketchedRecordSet(save=True)
+        s2.bulk(xrange(1, 91))
+        s3 = SketchedRecordSet(save=True)
+        s3.bulk(xrange(21, 121))
+        s4 = SketchedRecordSet(save=True)
+        s4.bulk(xrange(1000, 1100))
+        SketchedRecordSet(save=True)
+
+        with self.assertNumQueries(2):
+            similar = SketchedRecordSet.similar_to(s1, k=2)
+
+        self.assertEqual([s.pk for s, _ in similar], [s2.pk, s3.pk])
+        self.assertTrue(similar[0][1] > 0.7)
+        self.assertTrue(abs(s1.similarity(s3) - 80 / 120.0) < 0.15)
+
+        self.assertEqual(SketchedRecordSet.similar_to(s1, k=1)[0][0], s2)
+        self.assertEqual(
+            SketchedRecordSet.similar_to(SketchedRecordSet(save=True)), [])
+
+    def test_signature_bands(self):
+        s = SketchedRecordSet(save=True)
+        bands = SignatureBand.objects.filter(set_pk=s.pk)
+        self.assertEqual(bands.count(), 0)
+
+        # The bands are replaced when the signature changes
+        s.bulk(xrange(1, 11))
+        hashes = band_hashes(s._get_minhash(), s.minhash_bands)
+        self.assertEqual(sorted(bands.values_list('band', 'hash')), hashes)
+
+        s.add(Record(pk=11))
+        self.assertEqual(bands.count(), 32)
+        self.assertNotEqual(sorted(bands.values_list('band', 'hash')), hashes)
+
+        # Removals do not change the signature
+        with self.assertNumQueries(3):
+            s.remove(Record(pk=11))
+
+        s.rebuild_sketches()
+        self.assertEqual(sorted(bands.values_list('band', 'hash')), hashes)
+
+        s.clear()
+        self.assertEqual(bands.count(), 0)
+
+        s.bulk(xrange(1, 11))
+        s.delete()
+        self.assertEqual(bands.count(), 0)
+
+    def test_objectset(self):
+        s1 = SketchedRecordSet([Record(pk=i) for i in xrange(1, 5)],
+                               save=True)
+        self.assertEqual(s1.approx_count(), 4)
+
+        s2 = SketchedRecordSet(save=True)
+        s2.bulk(xrange(3, 8))
+        s2.add(Record(pk=9))
+        self.assertEqual(s2.approx_count(), 6)
+
+        s2 = SketchedRecordSet.objects.get(pk=s2.pk)
+        self.assertEqual(s1.approx_union(s2), 8)
+        self.assertEqual(s1.approx_intersection(s2), 2)
+
+        # Removals are only reflected once the sketch is rebuilt
+        s2.remove(Record(pk=9))
+        self.assertEqual(s2.approx_count(), 6)
+        call_command('rebuild_objectset_sketches', 'tests.SketchedRecordSet',
+                     verbosity=0)
+        s2 = SketchedRecordSet.objects.get(pk=s2.pk)
+        self.assertEqual(s2.approx_count(), 5)
+
+        s2.clear()
+        self.assertEqual(s2.approx_count(), 0)
+
+        self.assertRaises(ImproperlyConfigured,
+                          SimpleRecordSet().approx_count)
+
+
+class IndexTestCase(TestCase):
+    def test_indexes(self):
+        names = [i.name for i in
+                 indexes.get_set_object_indexes(RecordSet, connection)]
+        self.assertEqual(names, ['tests_recordsetobject_objset_members',
+                                 'tests_recordsetobject_objset_live'])
+
+        # Covered by the unique index of auto-created through models
+        self.assertEqual(
+            indexes.get_set_object_indexes(SimpleRecordSet, connection), [])
+
+        missing = indexes.get_missing_indexes(RecordSet)
+        self.assertEqual(len(missing), 2)
+        self.assertTrue(missing[1].sql(connection).endswith(
+            'WHERE "removed" = 0'))
+
+        out = StringIO()
+        call_command('objectset_indexes', 'tests.RecordSet', stdout=out)
+        self.assertEqual(out.getvalue().count('CREATE INDEX'), 2)
+
+        call_command('objectset_indexes', 'tests.RecordSet', create=True,
+                     verbosity=0)
+        self.assertEqual(indexes.get_missing_indexes(RecordSet), [])
+
+        existing = indexes.get_existing_indexes(connection,
+                                                'tests_recordsetobject')
+        self.assertEqual(existing['tests_recordsetobject_objset_members'],
+                         ['object_set_id', 'removed', 'set_object_id'])
+
+        # Queries still work with the indexes
+        s = RecordSet([1, 2], save=True)
+        s.remove(Record(pk=1))
+        self.assertEqual([o.pk for o in s], [2])
+
+    @override_settings(OBJECTSET_CREATE_INDEXES=True)
+    def test_syncdb(self):
+        _create_indexes(None, created_models=set([RecordSet, Record]),
+                        db='default')
+        self.assertEqual(indexes.get_missing_indexes(RecordSet), [])
+
+    @override_settings(OBJECTSET_CREATE_INDEXES=True)
+    def test_syncdb_unsupported(self):
+        vendor = connection.vendor
+        connection.vendor = 'oracle'
+
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                _create_indexes(None, created_models=set([RecordSet]),
+                                db='default')
+        finally:
+            connection.vendor = vendor
+
+        self.assertEqual(len(caught), 1)
+        self.assertTrue('oracle' in str(caught[0].message))
+
 
 class SetFormTest(TestCase):
     def test(self):